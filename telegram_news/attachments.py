@@ -0,0 +1,262 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Content-addressed cache of downloaded attachments.
+
+Photos, videos, thumbnails and compressed videos are kept in the
+attachments directory under the hash of their content, so the same
+content behind different URLs is stored once. Keys (media URLs, or
+derived keys like compressed outputs) point to the content, and the
+index of keys is saved in the directory to survive restarts.
+
+The directory is kept under a byte budget by evicting the least recently
+used files, except files pinned by messages waiting to be sent. Use
+`get_attachment_cache` to share one cache per directory among postmen.
+
+A cache directory belongs to one process. The index and the sizes are
+kept in memory and saved from there, so processes sharing a directory
+would overwrite the keys of each other and evict files the other one
+holds. Give each process its own attachments directory.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+DEFAULT_MAX_BYTES = int(2E9)   # (2GB)
+INDEX_FILE_NAME = 'index.json'
+
+# Files being written, never taken into the cache
+_TEMPORARY_EXTENSIONS = ('.part', '.tmp', '.ytdl', '.progress', '.log', '.mbtree')
+
+
+def get_file_hash(path, chunk_size=64 * 1024):
+    """Get the SHA-256 hex digest of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class AttachmentCache(object):
+    """
+    Attachment files in one directory, named by content hash, within a byte budget.
+
+    Files in the directory before the cache was created are counted in
+    the budget too, and are the first to be evicted.
+
+    Safe to share among threads, but not among processes: use one
+    directory per process.
+
+    Attributes:
+        directory
+        max_bytes
+        size
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Load files and the key index of `directory`, create it if needed.
+
+        :param str directory: attachments directory.
+        :param int max_bytes: max bytes of all files, least recently used ones are evicted.
+        """
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.size = 0
+        # File name to size, from least to most recently used
+        self._files = OrderedDict()
+        self._keys = {}
+        self._pins = {}
+        self._lock = threading.RLock()
+        os.makedirs(self.directory, exist_ok=True)
+        self._index_path = os.path.join(self.directory, INDEX_FILE_NAME)
+        self._index_mtime = None
+        self._shared_warned = False
+        self._load()
+
+    def _load(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name == INDEX_FILE_NAME or name.endswith(_TEMPORARY_EXTENSIONS) or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._files[name] = size
+            self.size += size
+
+        if os.path.exists(self._index_path):
+            try:
+                with open(self._index_path, 'r') as f:
+                    keys = json.load(f)
+            except ValueError as e:
+                print('Attachment index ' + self._index_path + ' is broken, ignore it (' + str(e) + ').')
+                keys = {}
+            self._keys = {key: name for key, name in keys.items() if name in self._files}
+            self._index_mtime = self._get_index_mtime()
+
+    def _get_index_mtime(self):
+        try:
+            return os.stat(self._index_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _save(self):
+        # The index was written by someone else since the last save
+        if not self._shared_warned and self._get_index_mtime() != self._index_mtime:
+            self._shared_warned = True
+            print('\033[33mAttachment index ' + self._index_path + ' was changed by another process! '
+                  'Use one attachments directory per process.\033[0m')
+        temp_path = self._index_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self._keys, f)
+        os.replace(temp_path, self._index_path)
+        self._index_mtime = self._get_index_mtime()
+
+    def get(self, key, pin=False):
+        """
+        Get the cached file of a key.
+
+        :param str key: media URL or derived key.
+        :param pin: pin the file as `pin` does, under the same lock, so that it can not be evicted in between.
+        :return: full path of the file, None if not cached.
+        """
+        with self._lock:
+            name = self._keys.get(key)
+            if name is None:
+                return None
+            path = os.path.join(self.directory, name)
+            if name not in self._files or not os.path.isfile(path):
+                # Deleted by someone else
+                self._forget(name)
+                self._save()
+                return None
+            self._files.move_to_end(name)
+            if pin:
+                self._pins[name] = self._pins.get(name, 0) + 1
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return path
+
+    def add(self, key, path, pin=False):
+        """
+        Put a file into the cache under its content hash.
+
+        A file inside the directory is moved, a file outside of it is
+        copied. If the same content is cached already, the new file is
+        dropped and the cached one is used.
+
+        :param str key: media URL or derived key, None to cache the content only.
+        :param str path: file to put.
+        :param pin: pin the cached file as `pin` does, before other files are evicted.
+        :return: full path of the cached file.
+        """
+        name = get_file_hash(path) + os.path.splitext(path)[1]
+        cached_path = os.path.join(self.directory, name)
+        inside = os.path.dirname(os.path.abspath(path)) == self.directory
+        with self._lock:
+            if name in self._files and os.path.isfile(cached_path):
+                if inside and os.path.abspath(path) != cached_path:
+                    os.remove(path)
+            else:
+                if inside:
+                    os.replace(path, cached_path)
+                else:
+                    shutil.copyfile(path, cached_path)
+                self._forget(name)
+                size = os.path.getsize(cached_path)
+                self._files[name] = size
+                self.size += size
+            self._files.move_to_end(name)
+            if key is not None:
+                self._keys[key] = name
+            if pin:
+                self._pins[name] = self._pins.get(name, 0) + 1
+            self._evict()
+            self._save()
+        return cached_path
+
+    def pin(self, paths):
+        """Keep cached files from being evicted until `unpin`, for messages waiting to be sent."""
+        with self._lock:
+            for path in paths:
+                name = os.path.basename(path)
+                self._pins[name] = self._pins.get(name, 0) + 1
+
+    def unpin(self, paths):
+        with self._lock:
+            for path in paths:
+                name = os.path.basename(path)
+                count = self._pins.get(name, 0) - 1
+                if count > 0:
+                    self._pins[name] = count
+                else:
+                    self._pins.pop(name, None)
+            if self._evict():
+                self._save()
+
+    def _forget(self, name):
+        size = self._files.pop(name, None)
+        if size is not None:
+            self.size -= size
+        for key in [key for key, value in self._keys.items() if value == name]:
+            del self._keys[key]
+
+    def _evict(self):
+        """Delete least recently used files not pinned until the size fits, return True if any was deleted."""
+        evicted = False
+        # The most recently used file is just added or requested, keep it
+        for name in list(self._files)[:-1]:
+            if self.size <= self.max_bytes:
+                break
+            if name in self._pins:
+                continue
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print('Can not delete attachment ' + name + ' (' + str(e) + ').')
+                continue
+            self._forget(name)
+            evicted = True
+        return evicted
+
+    def __len__(self):
+        with self._lock:
+            return len(self._files)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._keys
+
+
+_attachment_caches = {}
+_attachment_caches_lock = threading.Lock()
+
+
+def get_attachment_cache(directory, max_bytes=None):
+    """
+    Get the shared attachment cache of a directory, create it if needed.
+
+    Caches are shared in this process only, other processes must use other directories.
+
+    :param str directory: attachments directory.
+    :param int max_bytes: byte budget, None to keep the current one (or the default for a new cache).
+    :return: AttachmentCache
+    """
+    directory = os.path.abspath(directory)
+    with _attachment_caches_lock:
+        if directory not in _attachment_caches:
+            _attachment_caches[directory] = AttachmentCache(directory, max_bytes or DEFAULT_MAX_BYTES)
+        elif max_bytes is not None:
+            _attachment_caches[directory].max_bytes = max_bytes
+        return _attachment_caches[directory]
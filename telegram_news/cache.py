@@ -0,0 +1,208 @@
+# -*- coding: UTF-8 -*-
+
+"""
+In-memory cache of posted news ids in front of the database.
+
+`PostedCache` remembers ids known to be posted in a bounded LRU with an
+optional time to live. An optional Bloom filter holding every id of the
+table answers "definitely not posted" for new ids, so that steady-state
+polling does not need to ask the database at all.
+
+`FileIdCache` remembers the Telegram `file_id` of uploaded media, so that
+the same media is sent by id instead of being uploaded again.
+"""
+
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+
+
+class BloomFilter(object):
+    """
+    Bloom filter of strings.
+
+    It never gives false negatives, so a miss means the string was never
+    added. Items can not be removed.
+    """
+
+    def __init__(self, capacity=100000, error_rate=0.01):
+        """
+        Size the filter for `capacity` items at `error_rate` false positive rate.
+
+        :param int capacity: expected number of items.
+        :param float error_rate: false positive rate when `capacity` items are added.
+        """
+        capacity = max(1, capacity)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bit_number = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_number = max(1, int(round(self.bit_number / capacity * math.log(2))))
+        self.bits = bytearray((self.bit_number + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        digest = hashlib.md5(item.encode('utf-8')).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bit_number for i in range(self.hash_number)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class PostedCache(object):
+    """
+    Bounded cache of posted news ids.
+
+    Attributes:
+        max_size
+        ttl
+        bloom
+        complete
+    """
+
+    def __init__(self, max_size=10000, ttl=None, bloom_capacity=None, error_rate=0.01, clock=time.monotonic):
+        """
+        Create an empty cache.
+
+        :param int max_size: max ids kept in the LRU.
+        :param float ttl: seconds an id is trusted after it was added, None for no limit.
+        :param int bloom_capacity: expected ids in the table, None to disable the Bloom filter.
+        :param float error_rate: false positive rate of the Bloom filter.
+        :param function clock: An optional function retuning the current time.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.bloom = BloomFilter(bloom_capacity, error_rate) if bloom_capacity else None
+        # The Bloom filter can only answer misses after it was loaded with all ids of the table
+        self.complete = False
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, news_ids, complete=False):
+        """
+        Fill the cache from the table, from oldest to newest.
+
+        :param news_ids: posted news ids.
+        :param complete: True if `news_ids` are all ids of the table.
+        """
+        self.add(news_ids)
+        if complete:
+            self.complete = True
+
+    def add(self, news_ids):
+        """Remember ids as posted."""
+        now = self.clock()
+        with self._lock:
+            for news_id in news_ids:
+                news_id = str(news_id)
+                self._ids[news_id] = now
+                self._ids.move_to_end(news_id)
+                if self.bloom is not None:
+                    self.bloom.add(news_id)
+            while len(self._ids) > self.max_size:
+                self._ids.popitem(last=False)
+
+    def discard(self, news_ids):
+        """Forget ids, for rows deleted from the table."""
+        with self._lock:
+            for news_id in news_ids:
+                self._ids.pop(str(news_id), None)
+
+    def lookup(self, news_ids):
+        """
+        Split ids by what the cache knows.
+
+        :param news_ids: news id list.
+        :return: (set of posted ids, set of ids the database must be asked for), as strings.
+        """
+        posted_ids = set()
+        unknown_ids = set()
+        now = self.clock()
+        with self._lock:
+            for news_id in news_ids:
+                news_id = str(news_id)
+                added = self._ids.get(news_id)
+                if added is not None and (self.ttl is None or now - added <= self.ttl):
+                    self._ids.move_to_end(news_id)
+                    posted_ids.add(news_id)
+                elif self.bloom is not None and self.complete and news_id not in self.bloom:
+                    continue  # Definitely not posted
+                else:
+                    unknown_ids.add(news_id)
+        return posted_ids, unknown_ids
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+            if self.bloom is not None:
+                self.bloom = BloomFilter(self.bloom.capacity, self.bloom.error_rate)
+            self.complete = False
+
+
+def get_file_id(message):
+    """
+    Get the file id of the media in a sent Telegram message.
+
+    :param message: Message object of Telegram Bot API.
+    :return: file id of the largest photo or of the video, None if no media.
+    """
+    if not isinstance(message, dict):
+        return None
+    if message.get('photo'):
+        return message['photo'][-1].get('file_id')
+    for key in ('video', 'animation', 'document'):
+        if message.get(key):
+            return message[key].get('file_id')
+    return None
+
+
+class FileIdCache(object):
+    """
+    Bounded LRU of Telegram file ids.
+
+    A file id can only be used by the bot that received it, so ids are
+    kept per bot token and media source (url or local path).
+
+    Attributes:
+        max_size
+    """
+
+    def __init__(self, max_size=10000):
+        """
+        :param int max_size: max file ids kept, least recently used ones are evicted.
+        """
+        self.max_size = max_size
+        self._file_ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token, source):
+        """Get the file id of `source` for the bot, None if not known."""
+        with self._lock:
+            file_id = self._file_ids.get((token, source))
+            if file_id is not None:
+                self._file_ids.move_to_end((token, source))
+            return file_id
+
+    def set(self, token, source, file_id):
+        with self._lock:
+            self._file_ids[(token, source)] = file_id
+            self._file_ids.move_to_end((token, source))
+            while len(self._file_ids) > self.max_size:
+                self._file_ids.popitem(last=False)
+
+    def discard(self, token, source):
+        with self._lock:
+            self._file_ids.pop((token, source), None)
+
+    def clear(self):
+        with self._lock:
+            self._file_ids.clear()
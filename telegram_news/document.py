@@ -0,0 +1,210 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Parsed document shared by all extractor policies of one page.
+
+`ParsedDocument` is a `str`, so policies written for raw text still work,
+while built-in policies reuse the parse tree built on first access
+instead of parsing the page again.
+
+For the lxml backend, CSS selectors are compiled to XPath once and run on
+an `lxml.html` tree. `LxmlNode` wraps lxml elements with the part of the
+BeautifulSoup API that extractor policies use, so both backends can share
+the same policy code.
+"""
+
+import threading
+import warnings
+
+import lxml.html
+from bs4 import BeautifulSoup
+
+# Strings in these tags are not counted as text, as same as BeautifulSoup
+_NON_TEXT_TAGS = ('script', 'style', 'template')
+
+_compiled_selectors = {}
+_compiled_selectors_lock = threading.Lock()
+
+
+class ParsedDocument(str):
+    """Raw page text that is parsed at most once for each backend."""
+
+    def __new__(cls, text):
+        document = super(ParsedDocument, cls).__new__(cls, text)
+        document._soup = None
+        document._tree = None
+        return document
+
+    @property
+    def soup(self):
+        """BeautifulSoup tree of the page, built on first access."""
+        if self._soup is None:
+            self._soup = BeautifulSoup(self, 'lxml')
+        return self._soup
+
+    @property
+    def tree(self):
+        """LxmlNode of the lxml.html tree of the page, built on first access."""
+        if self._tree is None:
+            self._tree = parse_tree(self)
+        return self._tree
+
+
+def get_soup(text):
+    """
+    Get the parse tree of a page.
+
+    :param text: ParsedDocument or raw text string.
+    :return: BeautifulSoup object, shared if `text` is a ParsedDocument.
+    """
+    if isinstance(text, ParsedDocument):
+        return text.soup
+    return BeautifulSoup(text, 'lxml')
+
+
+def get_tree(text):
+    """
+    Get the lxml parse tree of a page.
+
+    :param text: ParsedDocument or raw text string.
+    :return: LxmlNode of the document, shared if `text` is a ParsedDocument.
+    """
+    if isinstance(text, ParsedDocument):
+        return text.tree
+    return parse_tree(text)
+
+
+def parse_tree(text):
+    """
+    Parse text by lxml.html.
+
+    :param text: raw text string.
+    :return: LxmlNode of the document, whose selectors can match <html> like BeautifulSoup.
+    """
+    if not text or not text.strip():
+        text = '<html><body></body></html>'
+    try:
+        root = lxml.html.document_fromstring(text)
+    except ValueError:
+        # Unicode strings with encoding declaration are not supported by lxml
+        root = lxml.html.document_fromstring(text.encode('utf-8'),
+                                             parser=lxml.html.HTMLParser(encoding='utf-8'))
+    return LxmlNode(root.getroottree())
+
+
+def lxml_backend_available():
+    """Check whether the lxml backend can compile CSS selectors."""
+    try:
+        import cssselect  # noqa: F401
+    except ModuleNotFoundError:
+        return False
+    return True
+
+
+def compile_selector(selector):
+    """
+    Compile a CSS selector to XPath, only once for each selector.
+
+    :param selector: CSS selector string.
+    :return: lxml.cssselect.CSSSelector, or None if it can not be translated.
+    """
+    with _compiled_selectors_lock:
+        if selector in _compiled_selectors:
+            return _compiled_selectors[selector]
+    from lxml.cssselect import CSSSelector
+    try:
+        compiled = CSSSelector(selector, translator='html')
+    except Exception as e:  # SelectorSyntaxError and ExpressionError
+        warnings.warn('Selector "' + selector + '" is not supported by lxml backend (' + str(e) + ').', stacklevel=2)
+        compiled = None
+    with _compiled_selectors_lock:
+        _compiled_selectors[selector] = compiled
+    return compiled
+
+
+def _text_of(element):
+    """Concatenate the strings of an element as same as BeautifulSoup `get_text`."""
+    parts = []
+    stack = [(element, False)]
+    while stack:
+        node, closing = stack.pop()
+        if closing:
+            if node is not element and node.tail:
+                parts.append(node.tail)
+            continue
+        stack.append((node, True))
+        # Comments and processing instructions have a non-string tag
+        if not isinstance(node.tag, str) or node.tag in _NON_TEXT_TAGS:
+            continue
+        if node.text:
+            parts.append(node.text)
+        for child in reversed(node):
+            stack.append((child, False))
+    return ''.join(parts)
+
+
+class LxmlNode(object):
+    """An lxml element with the BeautifulSoup API used by extractor policies."""
+
+    __slots__ = ('element',)
+
+    def __init__(self, element):
+        self.element = element
+
+    def select(self, selector):
+        """
+        Select descendants by a compiled CSS selector.
+
+        :param selector: CSS selector string.
+        :return: LxmlNode list.
+        """
+        compiled = compile_selector(selector)
+        if compiled is None:
+            raise ValueError('Selector "' + selector + '" is not supported by lxml backend.')
+        return [LxmlNode(e) for e in compiled(self.element) if e is not self.element]
+
+    def get(self, key, default=None):
+        return self.element.get(key, default)
+
+    def get_text(self):
+        return _text_of(self.element)
+
+    getText = get_text
+
+    def find(self, name):
+        """Find the first descendant tag by name."""
+        for element in self.element.iterdescendants(name):
+            return LxmlNode(element)
+        return None
+
+    @property
+    def body(self):
+        body = self.element.find('body')
+        return LxmlNode(body) if body is not None else None
+
+    def append(self, node):
+        self.element.append(node.element)
+
+    def extract(self):
+        """Remove the element from its parent, keep its tail text in the parent."""
+        parent = self.element.getparent()
+        if parent is not None:
+            tail = self.element.tail
+            self.element.tail = None
+            previous = self.element.getprevious()
+            if tail:
+                if previous is not None:
+                    previous.tail = (previous.tail or '') + tail
+                else:
+                    parent.text = (parent.text or '') + tail
+            parent.remove(self.element)
+        return self
+
+    def __str__(self):
+        return lxml.html.tostring(self.element, encoding='unicode', with_tail=False)
+
+    def __eq__(self, other):
+        return isinstance(other, LxmlNode) and other.element is self.element
+
+    def __hash__(self):
+        return hash(self.element)
@@ -0,0 +1,98 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Incremental diff of news lists.
+
+`ListDiff` remembers a compact fingerprint of every item seen in a list,
+keyed by news id in insertion order. Each cycle only the items that are
+new or whose content changed are returned, so posted checks and full
+page fetches run on the delta instead of the whole list.
+"""
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+DEFAULT_MAX_SIZE = 10000
+
+
+def fingerprint(item):
+    """
+    Get a compact fingerprint of an item.
+
+    :param item: dict of item information.
+    :return: 8 bytes digest of the content.
+    """
+    content = json.dumps(item, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.md5(content.encode('utf-8')).digest()[:8]
+
+
+def unique_items(items):
+    """
+    Remove items with repeated ids, from oldest to newest.
+
+    The lists are from newest to oldest, so the last occurrence of an id
+    is kept.
+
+    :param items: items from newest to oldest.
+    :return: unique items from oldest to newest.
+    """
+    seen = set()
+    result = []
+    for item in reversed(items):
+        news_id = str(item['id'])
+        if news_id not in seen:
+            seen.add(news_id)
+            result.append(item)
+    return result
+
+
+class ListDiff(object):
+    """
+    Id-keyed fingerprints of seen items.
+
+    Attributes:
+        max_size
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        """
+        :param int max_size: max ids remembered, the oldest seen ids are forgotten first.
+        """
+        self.max_size = max_size
+        self._fingerprints = OrderedDict()
+        self._lock = threading.Lock()
+
+    def update(self, items):
+        """
+        Remember items and get the new or changed ones.
+
+        :param items: unique items.
+        :return: new or changed items, in the order of `items`.
+        """
+        changed = []
+        with self._lock:
+            for item in items:
+                news_id = str(item['id'])
+                digest = fingerprint(item)
+                if self._fingerprints.get(news_id) != digest:
+                    changed.append(item)
+                self._fingerprints[news_id] = digest
+                self._fingerprints.move_to_end(news_id)
+            while len(self._fingerprints) > self.max_size:
+                self._fingerprints.popitem(last=False)
+        return changed
+
+    def discard(self, news_ids):
+        """Forget ids, they are returned again when seen next time."""
+        with self._lock:
+            for news_id in news_ids:
+                self._fingerprints.pop(str(news_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._fingerprints.clear()
+
+    def __len__(self):
+        return len(self._fingerprints)
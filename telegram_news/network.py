@@ -0,0 +1,255 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Pooled HTTP sessions for fetching, downloading and posting.
+
+All requests of the package go through one `requests.Session`, so that
+connections to the same news host or to api.telegram.org are kept alive
+and reused instead of paying a new TCP and TLS handshake each time.
+
+Cache validators of list pages are kept in `ValidatorStore`, to send
+conditional requests and skip unchanged pages.
+"""
+
+import http.cookiejar
+import json
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from urlparse import urlparse
+except Exception:  # For Python 3
+    from urllib.parse import urlparse
+
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MAX_HOSTS = 256
+DEFAULT_ACCEPT_ENCODING = 'gzip, deflate'
+
+
+def get_host(url):
+    """Get the host (with port if any) of a url."""
+    return urlparse(url).netloc
+
+
+class SessionPool(object):
+    """
+    Keep-alive connection pool shared by news postmen.
+
+    Every host gets its own connection pool, pools of up to `max_hosts`
+    hosts are kept, the least recently used one is closed beyond that.
+    The pool size of a host can be configured by `set_host_pool_size`,
+    other hosts use `pool_size`.
+
+    The session keeps no cookies, so that cookies of one news site are
+    never sent to other hosts or to the Bot API. Cookies given by the
+    `cookies` argument of a request are still sent with it.
+
+    Attributes:
+        pool_size
+        max_hosts
+        accept_encoding
+        session
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, host_pool_sizes=None, accept_encoding=DEFAULT_ACCEPT_ENCODING,
+                 max_hosts=DEFAULT_MAX_HOSTS):
+        """
+        Create the session.
+
+        :param int pool_size: Max connections kept alive in the pool of one host, more can be opened
+            at the same time but are closed after use.
+        :param dict host_pool_sizes: Host to pool size, for hot hosts.
+        :param str accept_encoding: Value of `Accept-Encoding`, falsy to disable compression.
+        :param int max_hosts: Max hosts whose pools are kept, set it above the number of news hosts.
+        """
+        self.pool_size = pool_size
+        self.max_hosts = max_hosts
+        self.accept_encoding = accept_encoding
+        self.session = requests.Session()
+        # Reject cookies of all domains, like separate `requests.get` calls
+        self.session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        # `pool_connections` is the number of host pools kept, `pool_maxsize` the size of each one
+        self.session.mount('http://', HTTPAdapter(pool_connections=max_hosts, pool_maxsize=pool_size))
+        self.session.mount('https://', HTTPAdapter(pool_connections=max_hosts, pool_maxsize=pool_size))
+        if accept_encoding:
+            self.session.headers['Accept-Encoding'] = accept_encoding
+        self._host_adapters = {}
+        self._requests = {}
+        self._lock = threading.Lock()
+        for host, size in (host_pool_sizes or {}).items():
+            self.set_host_pool_size(host, size)
+
+    def set_host_pool_size(self, host, size):
+        """
+        Use a dedicated pool for one host.
+
+        :param str host: Host name, like `api.telegram.org`.
+        :param int size: Max connections kept alive in the pool of this host.
+        """
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size)
+        with self._lock:
+            self._host_adapters[host] = adapter
+            for scheme in ('http://', 'https://'):
+                self.session.mount(scheme + host + '/', adapter)
+
+    def request(self, method, url, **kwargs):
+        """
+        Send a request through the pool, arguments are as same as `requests.request`.
+
+        :return: requests.Response
+        """
+        host = get_host(url)
+        with self._lock:
+            self._requests[host] = self._requests.get(host, 0) + 1
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def stats(self):
+        """
+        Get per-host pool statistics.
+
+        `requests` is the number of requests sent by this pool, while
+        `connections` is the number of connections really opened, so the
+        difference between them is the number of reused connections.
+
+        :return: dict of host to statistics dict.
+        """
+        with self._lock:
+            result = {
+                host: {'requests': count, 'connections': 0, 'pool_size': self.pool_size}
+                for host, count in self._requests.items()
+            }
+            adapters = set(self.session.adapters.values())
+            for host, adapter in self._host_adapters.items():
+                result.setdefault(host, {'requests': 0, 'connections': 0})['pool_size'] = adapter._pool_maxsize
+        for adapter in adapters:
+            for key in list(adapter.poolmanager.pools.keys()):
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is None:
+                    continue
+                host = pool.host if pool.port in (None, 80, 443) else '{}:{}'.format(pool.host, pool.port)
+                entry = result.setdefault(host, {'requests': 0, 'connections': 0, 'pool_size': self.pool_size})
+                entry['connections'] += pool.num_connections
+        return result
+
+    def close(self):
+        self.session.close()
+
+
+class ValidatorStore(object):
+    """
+    Store of HTTP cache validators (`ETag` and `Last-Modified`) per key.
+
+    Keys are given by users of the store, like a list URL scoped by the
+    postman polling it, so that postmen sharing a store do not send the
+    validators of each other.
+
+    With a `path`, validators are saved as a JSON file so that conditional
+    requests still work after restart. Without it, validators only live in
+    memory. Use `get_validator_store` to share one store per file among
+    postmen.
+    """
+
+    def __init__(self, path=None):
+        """
+        Load validators from `path` if it exists.
+
+        :param str path: JSON file path, or None to keep validators in memory only.
+        """
+        self.path = path
+        self._validators = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self._validators = json.load(f)
+            except ValueError as e:
+                print('Validator store ' + path + ' is broken, ignore it (' + str(e) + ').')
+
+    def get(self, key):
+        """
+        Get conditional request headers of a key.
+
+        :param str key: list url, or a key derived from it.
+        :return: header dict, empty if nothing was stored.
+        """
+        with self._lock:
+            validator = self._validators.get(key)
+        headers = {}
+        if validator:
+            if validator.get('etag'):
+                headers['If-None-Match'] = validator['etag']
+            if validator.get('last_modified'):
+                headers['If-Modified-Since'] = validator['last_modified']
+        return headers
+
+    def update(self, validators):
+        """
+        Set validators and save them.
+
+        :param dict validators: key to dict with `etag` and `last_modified`.
+        """
+        if not validators:
+            return
+        with self._lock:
+            self._validators.update(validators)
+            self._save()
+
+    def discard(self, keys):
+        """Forget validators of `keys`, the next request will be unconditional."""
+        with self._lock:
+            changed = False
+            for key in keys:
+                if self._validators.pop(key, None) is not None:
+                    changed = True
+            if changed:
+                self._save()
+
+    def _save(self):
+        if not self.path:
+            return
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self._validators, f)
+        os.replace(temp_path, self.path)
+
+
+_validator_stores = {}
+_validator_stores_lock = threading.Lock()
+
+
+def get_validator_store(path):
+    """
+    Get the shared validator store of a file, create it if needed.
+
+    :param str path: JSON file path.
+    :return: ValidatorStore
+    """
+    path = os.path.abspath(path)
+    with _validator_stores_lock:
+        if path not in _validator_stores:
+            _validator_stores[path] = ValidatorStore(path)
+        return _validator_stores[path]
+
+
+def get_validators(response):
+    """
+    Get validators from a response.
+
+    :param response: requests.Response
+    :return: dict with `etag` and `last_modified`, or None if the response has neither.
+    """
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if not etag and not last_modified:
+        return None
+    return {'etag': etag, 'last_modified': last_modified}
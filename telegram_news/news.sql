@@ -0,0 +1,10 @@
+CREATE TABLE IF NOT EXISTS news
+(
+    id      BIGSERIAL PRIMARY KEY,
+    source  VARCHAR   NOT NULL,
+    news_id VARCHAR   NOT NULL,
+    time    TIMESTAMP NOT NULL DEFAULT NOW()
+);
+CREATE UNIQUE INDEX IF NOT EXISTS news_source_news_id_key ON news (source, news_id);
+CREATE INDEX IF NOT EXISTS news_source_id_idx ON news (source, id);
+CREATE INDEX IF NOT EXISTS news_time_idx ON news (time);
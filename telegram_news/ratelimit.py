@@ -13,6 +13,10 @@ For channel, 20 per 60 seconds and 1 per 1 second are possible limit rate.
 In my experiment, a better result for no 429 error is once per 3 seconds.
 But, if you want to post messages as soon as possible, not using rate limit
 decorator is the most fast way.
+
+`SendScheduler` keeps separate token buckets for every bot token and every
+chat, so that the limits above are applied where Telegram applies them
+instead of once for the whole process.
 """
 
 import sys
@@ -21,6 +25,12 @@ import time
 from functools import wraps
 from math import floor
 
+from .constant import (
+    MAX_MESSAGES_PER_SECOND,
+    MAX_MESSAGES_PER_SECOND_PER_CHAT,
+    MAX_MESSAGES_PER_MINUTE_PER_GROUP,
+)
+
 
 class RateLimitException(Exception):
     """Created exception class for rate limit occurrences."""
@@ -151,3 +161,138 @@ def sleep_and_retry(func):
                 time.sleep(exception.period_remaining)
 
     return wrapper
+
+
+class TokenBucket(object):
+    """
+    Token bucket for one rate limit budget.
+
+    The bucket holds at most `capacity` tokens and refills them uniformly
+    over `period` seconds, so short bursts are allowed while the long run
+    rate never exceeds `capacity` per `period`.
+    """
+
+    def __init__(self, capacity, period, clock=now()):
+        """
+        Create a full bucket.
+
+        :param int capacity: Maximum tokens (burst size) of the bucket.
+        :param float period: Seconds needed to refill a whole bucket.
+        :param function clock: An optional function retuning the current time.
+        """
+        self.capacity = max(1, capacity)
+        self.rate = self.capacity / float(period)
+        self.clock = clock
+        self.tokens = float(self.capacity)
+        self.last_refill = clock()
+
+    def _refill(self):
+        current = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (current - self.last_refill) * self.rate)
+        self.last_refill = current
+
+    def wait_time(self):
+        """
+        Return seconds to wait until one token is available.
+
+        :return: 0 if a token can be consumed right now.
+        :rtype: float
+        """
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        """Take one token, the caller must check `wait_time` first."""
+        self.tokens -= 1
+
+    def drain(self, seconds):
+        """Empty the bucket so that no token is available for `seconds`."""
+        self._refill()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+class SendScheduler(object):
+    """
+    Send scheduler with separate budgets for bot tokens and chats.
+
+    Every bot token has its own bucket of `MAX_MESSAGES_PER_SECOND` calls
+    per second. Every (token, chat) pair has a bucket of
+    `MAX_MESSAGES_PER_SECOND_PER_CHAT` calls per second and a bucket of
+    `MAX_MESSAGES_PER_MINUTE_PER_GROUP` calls per minute. A send waits
+    until all buckets it touches have a token, so different bots and
+    different chats never block each other.
+    """
+
+    def __init__(self, per_token=MAX_MESSAGES_PER_SECOND, per_chat=MAX_MESSAGES_PER_SECOND_PER_CHAT,
+                 per_chat_minute=MAX_MESSAGES_PER_MINUTE_PER_GROUP, clock=now()):
+        """
+        Instantiate a scheduler with Telegram limits as defaults.
+
+        :param int per_token: Maximum calls per second for one bot token.
+        :param int per_chat: Maximum calls per second for one chat.
+        :param int per_chat_minute: Maximum calls per minute for one chat.
+        :param function clock: An optional function retuning the current time.
+        """
+        self.per_token = per_token
+        self.per_chat = per_chat
+        self.per_chat_minute = per_chat_minute
+        self.clock = clock
+        self._token_buckets = {}
+        self._chat_buckets = {}
+        self.lock = threading.Lock()
+
+    def _buckets(self, token, chat_id):
+        if token not in self._token_buckets:
+            self._token_buckets[token] = TokenBucket(self.per_token, 1, self.clock)
+        key = (token, str(chat_id))
+        if key not in self._chat_buckets:
+            self._chat_buckets[key] = (
+                TokenBucket(self.per_chat, 1, self.clock),
+                TokenBucket(self.per_chat_minute, 60, self.clock),
+            )
+        return (self._token_buckets[token],) + self._chat_buckets[key]
+
+    def try_acquire(self, token, chat_id):
+        """
+        Take a send budget if available, without blocking.
+
+        :param str token: Bot token used for sending.
+        :param chat_id: Target chat id or channel username.
+        :return: 0 if a message can be sent right now, otherwise seconds to wait before trying again.
+        :rtype: float
+        """
+        with self.lock:
+            buckets = self._buckets(token, chat_id)
+            wait = max(bucket.wait_time() for bucket in buckets)
+            if wait <= 0:
+                for bucket in buckets:
+                    bucket.consume()
+                return 0
+            return wait
+
+    def acquire(self, token, chat_id):
+        """
+        Block the current thread until a message can be sent.
+
+        :param str token: Bot token used for sending.
+        :param chat_id: Target chat id or channel username.
+        """
+        while True:
+            wait = self.try_acquire(token, chat_id)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def backoff(self, token, chat_id, seconds):
+        """
+        Hold back a chat after Telegram answered 429 with `retry_after`.
+
+        :param str token: Bot token that got the error.
+        :param chat_id: Target chat id or channel username.
+        :param float seconds: Seconds to hold back.
+        """
+        with self.lock:
+            for bucket in self._buckets(token, chat_id)[1:]:
+                bucket.drain(seconds)
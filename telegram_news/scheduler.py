@@ -0,0 +1,311 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Scheduler running many news postmen on a bounded pool of threads.
+
+Instead of one `poll()` thread per source, a `Scheduler` owns all postmen
+and runs their cycles on a fixed number of workers. Cycles start at a
+fixed rate, so the period of a source does not drift by its processing
+time, and a random jitter spreads sources with the same interval.
+
+With an `AdaptiveInterval`, the interval of a source follows how often
+its list really changes, between a min and a max interval.
+
+    scheduler = Scheduler(max_workers=4)
+    scheduler.add(np_1, interval=30, jitter=5)
+    scheduler.add(np_2, interval=60)
+    scheduler.add(np_3, interval=60, adaptive=AdaptiveInterval(min_interval=10, max_interval=1800))
+    scheduler.start()
+    ...
+    scheduler.shutdown()
+"""
+
+import heapq
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_MAX_WORKERS = 4
+
+
+class AdaptiveInterval(object):
+    """
+    Polling interval learned from the change rate of a source.
+
+    The rate of new items per second is smoothed by an exponentially
+    weighted moving average, and the interval is the time expected for
+    `items_per_poll` new items, kept between `min_interval` and
+    `max_interval`. Busy sources are polled often, dormant ones rarely.
+
+    Attributes:
+        min_interval
+        max_interval
+        interval
+        rate
+    """
+
+    def __init__(self, min_interval=10, max_interval=1800, initial=None, smoothing=0.3, items_per_poll=1,
+                 clock=time.monotonic):
+        """
+        :param min_interval: min seconds between two polls.
+        :param max_interval: max seconds between two polls.
+        :param initial: seconds of the first interval, default is `min_interval`.
+        :param smoothing: weight of the newest observation, in (0, 1].
+        :param items_per_poll: new items expected in one poll.
+        :param function clock: An optional function retuning the current time.
+        """
+        if not 0 < min_interval <= max_interval:
+            raise ValueError('Intervals must be positive and min_interval <= max_interval!')
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.smoothing = smoothing
+        self.items_per_poll = items_per_poll
+        self.clock = clock
+        self.interval = min(max(initial or min_interval, min_interval), max_interval)
+        self.rate = items_per_poll / float(self.interval)
+        self._last_update = None
+
+    def update(self, new_items, elapsed=None):
+        """
+        Learn from the result of one poll.
+
+        :param new_items: number of new items found, 0 if the list did not change.
+        :param elapsed: seconds since the last poll, default is measured by `clock`.
+        :return: seconds until the next poll.
+        """
+        current = self.clock()
+        if elapsed is None:
+            elapsed = self.interval if self._last_update is None else current - self._last_update
+        self._last_update = current
+        if elapsed > 0:
+            self.rate = self.smoothing * (new_items / float(elapsed)) + (1 - self.smoothing) * self.rate
+        if self.rate > 0:
+            interval = self.items_per_poll / self.rate
+        else:
+            interval = self.max_interval
+        self.interval = min(max(interval, self.min_interval), self.max_interval)
+        return self.interval
+
+
+class ScheduledJob(object):
+    """
+    Schedule state of one postman.
+
+    Attributes:
+        postman
+        interval
+        jitter
+        adaptive
+        next_run
+        removed
+    """
+
+    def __init__(self, postman, interval, jitter, next_run, adaptive=None):
+        self.postman = postman
+        self.interval = adaptive.interval if adaptive else interval
+        self.jitter = jitter
+        self.adaptive = adaptive
+        # Run time without jitter, the base of the fixed rate
+        self.base_time = next_run
+        self.next_run = next_run
+        self.removed = False
+
+    def advance(self, current):
+        """Set the next run after `current`, skip runs missed because the cycle overran."""
+        self.base_time += self.interval
+        if self.base_time < current:
+            missed = int((current - self.base_time) // self.interval) + 1
+            self.base_time += missed * self.interval
+        self.next_run = self.base_time + random.uniform(0, self.jitter)
+
+
+def _check_interval(interval):
+    if interval <= 0:
+        raise ValueError('Interval must be positive!')
+
+
+class Scheduler(object):
+    """
+    Run cycles of many postmen at fixed rates on a bounded worker pool.
+
+    A postman never runs two cycles at the same time. When all workers are
+    busy, due cycles wait for a free worker.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, clock=time.monotonic):
+        """
+        :param int max_workers: max cycles running at the same time.
+        :param function clock: An optional function retuning the current time.
+        """
+        self.max_workers = max_workers
+        self.clock = clock
+        self._jobs = {}
+        # Postmen with a running cycle, and their jobs due meanwhile
+        self._running = set()
+        self._waiting = {}
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._executor = None
+        self._dispatcher = None
+        self._stopping = False
+
+    def add(self, postman, interval=30, jitter=0, delay=None, adaptive=None):
+        """
+        Add a postman, it runs as soon as the scheduler is started.
+
+        :param postman: NewsPostman.
+        :param interval: seconds between the starts of two cycles.
+        :param jitter: max random seconds added to each start.
+        :param delay: seconds before the first cycle, default is a random value in `jitter`.
+        :param adaptive: AdaptiveInterval to learn the interval, instead of the fixed `interval`.
+        :return: True if added, False if the postman can not boot or is already added.
+        """
+        _check_interval(interval)
+        if not postman._boot_check():
+            return False
+        with self._condition:
+            if postman in self._jobs:
+                print('\033[33m' + postman._tag + ' is already scheduled!\033[0m')
+                return False
+            delay = random.uniform(0, jitter) if delay is None else delay
+            job = ScheduledJob(postman, interval, jitter, self.clock() + delay, adaptive)
+            self._jobs[postman] = job
+            self._push(job)
+        return True
+
+    def remove(self, postman):
+        """
+        Remove a postman, a running cycle is finished but not run again.
+
+        :return: True if the postman was scheduled.
+        """
+        with self._condition:
+            job = self._jobs.pop(postman, None)
+            if job is None:
+                return False
+            job.removed = True
+            self._condition.notify()
+        return True
+
+    def reschedule(self, postman, interval=None, jitter=None):
+        """Change the interval or jitter of a postman, from its next cycle."""
+        if interval is not None:
+            _check_interval(interval)
+        with self._condition:
+            job = self._jobs.get(postman)
+            if job is None:
+                return False
+            if interval is not None:
+                job.interval = interval
+                job.adaptive = None
+            if jitter is not None:
+                job.jitter = jitter
+            if postman not in self._running:
+                # Drop the old heap entry and schedule by the new values
+                job.removed = True
+                new_job = ScheduledJob(postman, job.interval, job.jitter,
+                                       self.clock() + random.uniform(0, job.jitter), job.adaptive)
+                self._jobs[postman] = new_job
+                self._push(new_job)
+        return True
+
+    def postmen(self):
+        with self._condition:
+            return list(self._jobs)
+
+    def _push(self, job):
+        heapq.heappush(self._heap, (job.next_run, next(self._counter), job))
+        self._condition.notify()
+
+    def start(self):
+        """Start workers and dispatching, return at once."""
+        with self._condition:
+            if self._dispatcher is not None:
+                return
+            self._stopping = False
+            # After a shutdown, schedule again all postmen not running
+            self._heap = []
+            for postman, job in list(self._jobs.items()):
+                if postman not in self._running:
+                    job = ScheduledJob(postman, job.interval, job.jitter,
+                                       self.clock() + random.uniform(0, job.jitter), job.adaptive)
+                    self._jobs[postman] = job
+                    self._push(job)
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            self._dispatcher = threading.Thread(target=self._dispatch, name='telegram-news-scheduler')
+            self._dispatcher.daemon = True
+            self._dispatcher.start()
+
+    def _dispatch(self):
+        with self._condition:
+            while not self._stopping:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                next_run, _, job = self._heap[0]
+                if job.removed:
+                    heapq.heappop(self._heap)
+                    continue
+                wait = next_run - self.clock()
+                if wait > 0:
+                    self._condition.wait(wait)
+                    continue
+                heapq.heappop(self._heap)
+                if job.postman in self._running:
+                    # A former job of the postman, removed and added again, is still running
+                    self._waiting[job.postman] = job
+                    continue
+                self._running.add(job.postman)
+                self._executor.submit(self._run, job)
+
+    def _run(self, job):
+        result = None
+        try:
+            result = job.postman.poll_once(job.interval)
+        finally:
+            with self._condition:
+                self._running.discard(job.postman)
+                waiting = self._waiting.pop(job.postman, None)
+                if waiting is not None and not waiting.removed and not self._stopping:
+                    self._push(waiting)
+                # Failed cycles tell nothing about the change rate
+                if job.adaptive is not None and result is not None:
+                    total = result[0]
+                    job.interval = job.adaptive.update(total or 0)
+                if not job.removed and not self._stopping:
+                    job.advance(self.clock())
+                    self._push(job)
+
+    def run_forever(self):
+        """Start and block until interrupted, then shut down gracefully."""
+        self.start()
+        try:
+            while self._dispatcher is not None and self._dispatcher.is_alive():
+                self._dispatcher.join(1)
+        except KeyboardInterrupt:
+            print('Stopping scheduler...')
+        finally:
+            self.shutdown()
+
+    def shutdown(self, wait=True):
+        """
+        Stop scheduling, let running cycles finish and write buffered posted ids.
+
+        :param wait: block until running cycles are finished.
+        """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+            executor, self._executor = self._executor, None
+            dispatcher, self._dispatcher = self._dispatcher, None
+            postmen = list(self._jobs)
+        if dispatcher is not None:
+            dispatcher.join()
+        if executor is not None:
+            executor.shutdown(wait=wait)
+        if wait:
+            for postman in postmen:
+                postman.flush()
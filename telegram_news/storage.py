@@ -0,0 +1,502 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Storage backends of posted news ids.
+
+A storage checks which news ids were posted, records new ones, sets up
+tables and deletes old rows. `NewsPostman` only talks to this interface,
+so the backend can be chosen by deployment:
+
+- `PostgresStorage` uses SQLAlchemy, by a session as before or by an engine.
+- `SQLiteStorage` keeps ids in a local file in WAL mode, no server needed.
+- `MemoryStorage` keeps ids in process, for tests and benchmarks.
+
+Every method takes the table name and the source, so one storage object
+can be shared by many postmen. Source None means a per-source table.
+"""
+
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from sqlalchemy.engine import (
+    Connection,
+    Engine,
+)
+from sqlalchemy.orm import (
+    Session,
+    scoped_session,
+    sessionmaker,
+)
+
+DEFAULT_CHUNK_SIZE = 500
+
+# Lock of each single session or connection, and the session made for a connection,
+# shared by all storages using the same one. A connection is kept by its session.
+_single_sessions = weakref.WeakKeyDictionary()
+_single_sessions_lock = threading.Lock()
+
+
+def _get_single_session(db):
+    """
+    Get the session of a session or connection and the lock serializing it, create them if needed.
+
+    :return: (session, lock)
+    """
+    with _single_sessions_lock:
+        if db not in _single_sessions:
+            _single_sessions[db] = (Session(bind=db) if isinstance(db, Connection) else None, threading.RLock())
+        session, lock = _single_sessions[db]
+    return session or db, lock
+
+
+def _chunks(items, chunk_size=DEFAULT_CHUNK_SIZE):
+    items = list(items)
+    for begin in range(0, len(items), chunk_size):
+        yield items[begin: begin + chunk_size]
+
+
+def _delete_number(row_number, max_rows):
+    """
+    Number of oldest rows to delete for the row cap.
+
+    If the rows exceed 2 of 3 of max rows, delete old 1 of 3 of max rows.
+    """
+    if max_rows == math.inf or row_number <= 2 * ((max_rows - 3) / 3):
+        return 0
+    return int(max_rows / 3)
+
+
+class _InsertCounter(object):
+    """
+    Rows inserted by this process per table and source since the last row cap probe.
+
+    After a probe finds at most 2 of 3 of `max_rows` rows, the rows can not
+    exceed `max_rows` before 1 of 3 of `max_rows` more are inserted, so the
+    next probe waits for that many inserts instead of walking the index on
+    every cycle. The first clean after start always probes.
+    """
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, table_name, source, number):
+        with self._lock:
+            key = (table_name, source)
+            if key in self._counts:
+                self._counts[key] += number
+
+    def probe_due(self, table_name, source, max_rows):
+        """Check if the row cap must be probed now, and if so start counting again."""
+        with self._lock:
+            key = (table_name, source)
+            if self._counts.get(key, math.inf) < int(max_rows / 3):
+                return False
+            self._counts[key] = 0
+            return True
+
+
+class BaseStorage(object):
+    """
+    Interface of posted id storage.
+
+    All news ids are handled as strings.
+    """
+
+    def setup(self, table_name, shared=False):
+        """
+        Create the table if not exists.
+
+        :param table_name: table name.
+        :param shared: create the table shared by sources, with a source column.
+        :return: True if the table is created, False if it already exists.
+        """
+        raise NotImplementedError
+
+    def get_posted_ids(self, table_name, source, news_ids):
+        """
+        Check which ids are posted.
+
+        :param news_ids: news id list.
+        :return: set of posted ids.
+        """
+        raise NotImplementedError
+
+    def load_ids(self, table_name, source):
+        """Get all posted ids, from oldest to newest."""
+        raise NotImplementedError
+
+    def insert(self, table_name, source, news_ids):
+        """Record ids as posted, in one transaction."""
+        raise NotImplementedError
+
+    def clean(self, table_name, source, max_rows=math.inf, max_age=None):
+        """
+        Delete old rows.
+
+        When the rows exceed 2 of 3 of `max_rows`, the oldest 1 of 3 of
+        `max_rows` rows are deleted. Rows older than `max_age` seconds are
+        always deleted.
+
+        Database storages check the row cap only after 1 of 3 of `max_rows`
+        rows were inserted since the last check, counted in this process, so
+        rows inserted by other processes are only seen at the next check.
+
+        :return: list of deleted ids.
+        """
+        raise NotImplementedError
+
+    def migrate(self, old_table_name, table_name, source, drop=False):
+        """
+        Copy ids from a per-source table to a shared table, skip ids already there.
+
+        :return: number of copied rows.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class PostgresStorage(BaseStorage):
+    """
+    Storage in PostgreSQL by SQLAlchemy.
+
+    With an engine or a session factory, every thread works in its own
+    session, and connections come from the engine pool. With a single
+    session or connection, calls are serialized by a lock of that session
+    instead, shared by all storages using it, so that threads never use it
+    at the same time.
+
+    Attributes:
+        db
+        chunk_size
+    """
+
+    def __init__(self, db, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        :param db: SQLAlchemy engine, sessionmaker, scoped_session, session or connection.
+        :param chunk_size: max ids in one statement.
+        """
+        self.db = db
+        self.chunk_size = chunk_size
+        self._inserted = _InsertCounter()
+        if isinstance(db, (Session, Connection)):
+            session, self._lock = _get_single_session(db)
+            self._sessions = lambda: session
+        else:
+            if isinstance(db, Engine):
+                db = sessionmaker(bind=db)
+            if not isinstance(db, scoped_session):
+                db = scoped_session(db)
+            self._sessions = db
+            self._lock = None
+
+    @contextmanager
+    def _session(self, commit=False):
+        """Get the session of this thread, roll back on errors so that it can be used again."""
+        if self._lock is not None:
+            self._lock.acquire()
+        session = self._sessions()
+        try:
+            yield session
+            if commit:
+                session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            if self._lock is not None:
+                self._lock.release()
+            else:
+                # Give the connection back to the pool
+                session.close()
+
+    @staticmethod
+    def _where(source, condition=None):
+        """Build the WHERE clause with `condition`, limited to `source` if any."""
+        conditions = ['source = :source'] if source is not None else []
+        if condition:
+            conditions.append(condition)
+        return ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+
+    @staticmethod
+    def _read_schema(file_name, table_name):
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), file_name)) as f:
+            lines = f.read()
+        # Rename the table and its indexes, but not the news_id column
+        return re.sub(r'\bnews\b|\bnews(?=_source|_time)', table_name, lines)
+
+    def setup(self, table_name, shared=False):
+        with self._session(commit=True) as db:
+            if shared:
+                db.execute(self._read_schema('news.sql', table_name))
+                print('Set shared table \"' + table_name + '\" successfully!')
+                return True
+            rows = db.execute("SELECT COUNT(*) FROM information_schema.tables WHERE table_name = :new_table_name ;",
+                              {"new_table_name": table_name})
+            if rows.fetchone()[0] == 1:
+                print('Set table name \"' + table_name + '\" successfully, table already exists!')
+                return False
+            print('New table name \"' + table_name + '\" is settable, setting...')
+            db.execute(self._read_schema('table.sql', table_name))
+        print('Create table finished!')
+        return True
+
+    def get_posted_ids(self, table_name, source, news_ids):
+        posted_ids = set()
+        with self._session() as db:
+            for chunk in _chunks({str(news_id) for news_id in news_ids}, self.chunk_size):
+                params = {'news_id_' + str(i): news_id for i, news_id in enumerate(chunk)}
+                query = "SELECT news_id FROM {}{}".format(
+                    table_name, self._where(source, 'news_id IN ({})'.format(', '.join(':' + key for key in params))))
+                params['source'] = source
+                posted_ids.update(row[0] for row in db.execute(query, params).fetchall())
+        return posted_ids
+
+    def load_ids(self, table_name, source):
+        query = "SELECT news_id FROM {}{} ORDER BY id ASC".format(table_name, self._where(source))
+        with self._session() as db:
+            return [row[0] for row in db.execute(query, {"source": source}).fetchall()]
+
+    def insert(self, table_name, source, news_ids):
+        # Commit all chunks at once
+        with self._session(commit=True) as db:
+            for chunk in _chunks(news_ids, self.chunk_size):
+                params = {'news_id_' + str(i): str(news_id) for i, news_id in enumerate(chunk)}
+                if source is None:
+                    query = "INSERT INTO {} (news_id, time) VALUES {}".format(
+                        table_name, ', '.join('(:' + key + ', NOW())' for key in params))
+                else:
+                    query = "INSERT INTO {} (source, news_id, time) VALUES {} ON CONFLICT DO NOTHING".format(
+                        table_name, ', '.join('(:source, :' + key + ', NOW())' for key in params))
+                    params['source'] = source
+                db.execute(query, params)
+        self._inserted.add(table_name, source, len(news_ids))
+
+    def clean(self, table_name, source, max_rows=math.inf, max_age=None):
+        deleted = []
+        params = {"source": source}
+        with self._session(commit=True) as db:
+            # Delete by age, by the time index
+            if max_age is not None:
+                query = "DELETE FROM {}{} RETURNING news_id".format(
+                    table_name, self._where(source, "time < NOW() - :max_age * INTERVAL '1 second'"))
+                params["max_age"] = max_age
+                deleted += [row[0] for row in db.execute(query, params).fetchall()]
+
+            # Probe rows at offsets by the id index instead of counting the table, once per max_rows / 3 inserts
+            if max_rows != math.inf and self._inserted.probe_due(table_name, source, max_rows):
+                query = "SELECT id FROM {}{} ORDER BY id ASC LIMIT 1 OFFSET :offset".format(
+                    table_name, self._where(source))
+                params["offset"] = int(2 * ((max_rows - 3) / 3))
+                if db.execute(query, params).fetchone() is not None:
+                    delete_number = int(max_rows / 3)
+                    print('delete ', delete_number)
+                    params["offset"] = max(delete_number - 1, 0)
+                    row = db.execute(query, params).fetchone()
+                    if row is not None:
+                        query = "DELETE FROM {}{} RETURNING news_id".format(
+                            table_name, self._where(source, "id <= :max_id"))
+                        params["max_id"] = row[0]
+                        deleted += [row[0] for row in db.execute(query, params).fetchall()]
+        return deleted
+
+    def migrate(self, old_table_name, table_name, source, drop=False):
+        query = "INSERT INTO {} (source, news_id, time) SELECT :source, news_id, COALESCE(time, NOW()) FROM {} " \
+                "ORDER BY id ASC ON CONFLICT (source, news_id) DO NOTHING".format(table_name, old_table_name)
+        with self._session(commit=True) as db:
+            rows = db.execute(query, {"source": source})
+            if drop:
+                db.execute("DROP TABLE {}".format(old_table_name))
+        return rows.rowcount
+
+    def close(self):
+        if self._lock is None:
+            self._sessions.remove()
+        else:
+            self._sessions().close()
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Storage in a local SQLite file, in WAL mode.
+
+    Tables always have a source column, a per-source table uses an empty
+    source. One connection is shared by threads under a lock.
+
+    Attributes:
+        path
+        chunk_size
+    """
+
+    def __init__(self, path='telegram_news.db', chunk_size=DEFAULT_CHUNK_SIZE, timeout=30):
+        """
+        Open or create the database file.
+
+        :param path: database file path, or ':memory:'.
+        :param chunk_size: max ids in one statement.
+        :param timeout: seconds to wait for a lock held by another process.
+        """
+        self.path = path
+        self.chunk_size = chunk_size
+        self._inserted = _InsertCounter()
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        # WAL lets readers run while writing, NORMAL sync is durable enough in WAL mode
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+
+    def setup(self, table_name, shared=False):
+        with self._lock, self._connection:
+            exists = self._connection.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                              (table_name,)).fetchone()[0]
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS {0} (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "source TEXT NOT NULL DEFAULT '', news_id TEXT NOT NULL, "
+                "time TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP)".format(table_name))
+            self._connection.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS {0}_source_news_id_key ON {0} (source, news_id)".format(table_name))
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS {0}_source_id_idx ON {0} (source, id)".format(table_name))
+            self._connection.execute("CREATE INDEX IF NOT EXISTS {0}_time_idx ON {0} (time)".format(table_name))
+        if exists:
+            print('Set table name \"' + table_name + '\" successfully, table already exists!')
+            return False
+        print('Create table \"' + table_name + '\" finished!')
+        return True
+
+    def get_posted_ids(self, table_name, source, news_ids):
+        posted_ids = set()
+        with self._lock:
+            for chunk in _chunks({str(news_id) for news_id in news_ids}, self.chunk_size):
+                query = "SELECT news_id FROM {} WHERE source = ? AND news_id IN ({})".format(
+                    table_name, ', '.join('?' * len(chunk)))
+                posted_ids.update(row[0] for row in self._connection.execute(query, [source or ''] + chunk))
+        return posted_ids
+
+    def load_ids(self, table_name, source):
+        with self._lock:
+            query = "SELECT news_id FROM {} WHERE source = ? ORDER BY id ASC".format(table_name)
+            return [row[0] for row in self._connection.execute(query, (source or '',))]
+
+    def insert(self, table_name, source, news_ids):
+        query = "INSERT OR IGNORE INTO {} (source, news_id) VALUES (?, ?)".format(table_name)
+        with self._lock, self._connection:
+            self._connection.executemany(query, [(source or '', str(news_id)) for news_id in news_ids])
+        self._inserted.add(table_name, source or '', len(news_ids))
+
+    def clean(self, table_name, source, max_rows=math.inf, max_age=None):
+        deleted = []
+        source = source or ''
+        with self._lock, self._connection:
+            if max_age is not None:
+                condition = "WHERE source = ? AND time < datetime('now', ?)"
+                params = (source, '-{} seconds'.format(max_age))
+                deleted += [row[0] for row in self._connection.execute(
+                    "SELECT news_id FROM {} {}".format(table_name, condition), params)]
+                self._connection.execute("DELETE FROM {} {}".format(table_name, condition), params)
+            # Probe as PostgresStorage does, once per max_rows / 3 inserts
+            if max_rows != math.inf and self._inserted.probe_due(table_name, source, max_rows):
+                query = "SELECT id FROM {} WHERE source = ? ORDER BY id ASC LIMIT 1 OFFSET ?".format(table_name)
+                if self._connection.execute(query, (source, int(2 * ((max_rows - 3) / 3)))).fetchone() is not None:
+                    delete_number = int(max_rows / 3)
+                    print('delete ', delete_number)
+                    row = self._connection.execute(query, (source, max(delete_number - 1, 0))).fetchone()
+                    if row is not None:
+                        condition = "WHERE source = ? AND id <= ?"
+                        deleted += [r[0] for r in self._connection.execute(
+                            "SELECT news_id FROM {} {}".format(table_name, condition), (source, row[0]))]
+                        self._connection.execute("DELETE FROM {} {}".format(table_name, condition), (source, row[0]))
+        return deleted
+
+    def migrate(self, old_table_name, table_name, source, drop=False):
+        query = "INSERT OR IGNORE INTO {} (source, news_id, time) SELECT ?, news_id, time FROM {} " \
+                "WHERE source = '' ORDER BY id ASC".format(table_name, old_table_name)
+        with self._lock, self._connection:
+            rows = self._connection.execute(query, (source or '',))
+            if drop:
+                self._connection.execute("DROP TABLE {}".format(old_table_name))
+        return rows.rowcount
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class MemoryStorage(BaseStorage):
+    """
+    Storage in process memory, lost at exit.
+
+    Ids are kept per table and source in insertion order.
+    """
+
+    def __init__(self, clock=time.time):
+        """
+        :param function clock: An optional function retuning the current time.
+        """
+        self.clock = clock
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def _rows(self, table_name, source):
+        return self._tables.setdefault(table_name, {}).setdefault(source or '', OrderedDict())
+
+    def setup(self, table_name, shared=False):
+        with self._lock:
+            if table_name in self._tables:
+                return False
+            self._tables[table_name] = {}
+            return True
+
+    def get_posted_ids(self, table_name, source, news_ids):
+        with self._lock:
+            rows = self._rows(table_name, source)
+            return {str(news_id) for news_id in news_ids if str(news_id) in rows}
+
+    def load_ids(self, table_name, source):
+        with self._lock:
+            return list(self._rows(table_name, source))
+
+    def insert(self, table_name, source, news_ids):
+        now = self.clock()
+        with self._lock:
+            rows = self._rows(table_name, source)
+            for news_id in news_ids:
+                rows.setdefault(str(news_id), now)
+
+    def clean(self, table_name, source, max_rows=math.inf, max_age=None):
+        deleted = []
+        with self._lock:
+            rows = self._rows(table_name, source)
+            if max_age is not None:
+                oldest = self.clock() - max_age
+                deleted += [news_id for news_id, added in rows.items() if added < oldest]
+                for news_id in deleted:
+                    del rows[news_id]
+            delete_number = _delete_number(len(rows), max_rows)
+            if delete_number:
+                print('delete ', delete_number)
+            for _ in range(min(delete_number, len(rows))):
+                deleted.append(rows.popitem(last=False)[0])
+        return deleted
+
+    def migrate(self, old_table_name, table_name, source, drop=False):
+        with self._lock:
+            old_rows = self._rows(old_table_name, None)
+            rows = self._rows(table_name, source)
+            copied = 0
+            for news_id, added in old_rows.items():
+                if news_id not in rows:
+                    rows[news_id] = added
+                    copied += 1
+            if drop:
+                del self._tables[old_table_name]
+        return copied
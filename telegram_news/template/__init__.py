@@ -15,3 +15,7 @@ from .common import (
     NewsPostmanJSON,
     NewsPostmanXML,
 )
+from .asynchronous import (
+    AsyncNewsPostman,
+    run_postmen,
+)
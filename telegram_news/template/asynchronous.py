@@ -0,0 +1,365 @@
+# -*- coding: UTF-8 -*-
+
+"""
+News Postman on asyncio, for many sources in one event loop.
+
+`AsyncNewsPostman` works as same as `NewsPostman`, with the same info
+extractors and display policies, but list pages, full pages and Telegram
+API calls are sent by aiohttp without blocking. Database work and media
+preparation (download, detection and compression) run in the default
+executor of the loop.
+
+Use `run_postmen` to poll many postmen in one thread:
+
+    run_postmen([np_1, np_2, np_3], sleep_time=30)
+"""
+
+import asyncio
+import os
+import traceback
+import weakref
+
+from ..network import get_host
+from ..transcode import VideoNotReady
+from .common import NewsPostman
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+DEFAULT_CONNECTION_LIMIT = 100
+DEFAULT_CONNECTION_LIMIT_PER_HOST = 10
+
+
+class AsyncResponse(object):
+    """
+    Response read by aiohttp, with the attributes of `requests.Response` used by postmen.
+
+    Attributes:
+        status_code
+        content
+        headers
+        encoding
+    """
+
+    def __init__(self, status_code, content, headers, encoding=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+        self.encoding = encoding
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or 'utf-8', errors='replace')
+
+
+class AsyncNewsPostman(NewsPostman):
+    """
+    News Postman class on asyncio.
+
+    One aiohttp client session is shared by all async postmen in the same
+    event loop, so connections are kept alive per host. It is closed when
+    the last `run` in the loop exits.
+
+    Attributes:
+        As same as NewsPostman.
+        _clients
+        _client_runs
+        _async_host_semaphores
+    """
+
+    # Client sessions are bound to the loop they are created in, so they are kept per event loop
+    _clients = weakref.WeakKeyDictionary()
+    _client_runs = weakref.WeakKeyDictionary()
+    # Per event loop, then per (host, per_host)
+    _async_host_semaphores = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def _get_client(cls):
+        """Get the client session of the running loop, create it if needed."""
+        loop = asyncio.get_event_loop()
+        # A client refers to its loop, forget clients of closed loops so that they can be freed
+        for closed_loop in [key for key in AsyncNewsPostman._clients if key.is_closed()]:
+            del AsyncNewsPostman._clients[closed_loop]
+        client = AsyncNewsPostman._clients.get(loop)
+        if client is None or client.closed:
+            connector = aiohttp.TCPConnector(limit=DEFAULT_CONNECTION_LIMIT,
+                                             limit_per_host=DEFAULT_CONNECTION_LIMIT_PER_HOST)
+            client = AsyncNewsPostman._clients[loop] = aiohttp.ClientSession(connector=connector)
+        return client
+
+    @classmethod
+    async def close_client(cls):
+        """Close the client session of the running loop."""
+        client = AsyncNewsPostman._clients.pop(asyncio.get_event_loop(), None)
+        if client is not None:
+            await client.close()
+
+    def _get_proxy(self):
+        if not self._proxies:
+            return None
+        return self._proxies.get('https') or self._proxies.get('http')
+
+    async def _request(self, method, url, timeout=None, proxy=None, **kwargs):
+        """
+        Send a request by the shared client session.
+
+        :param proxy: proxy url, as same as `requests`, only Telegram API calls use the proxies of the postman.
+        :return: AsyncResponse
+        """
+        timeout = aiohttp.ClientTimeout(total=timeout) if timeout else None
+        async with self._get_client().request(method, url, timeout=timeout, proxy=proxy, **kwargs) as res:
+            content = await res.read()
+            return AsyncResponse(res.status, content, res.headers)
+
+    async def _run_blocking(self, func, *args):
+        """Run blocking database or file work in the default executor."""
+        return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    async def _get_list_async(self, list_request_url, list_url=None):  # -> (list, int)
+        list_url = list_url or list_request_url
+        res = await self._request('GET', list_request_url, headers=self._get_list_headers(list_url),
+                                  timeout=self._list_request_timeout)
+        # Parsing blocks, keep it out of the event loop
+        return await self._run_blocking(self._handle_list_response, res, list_request_url, list_url)
+
+    async def _get_full_async(self, url, item):
+        text = ""
+        if url:
+            res = await self._request('GET', url, headers=self._headers, timeout=self._full_request_timeout)
+            res.encoding = self._full_request_response_encode
+            text = res.text
+        return await self._run_blocking(self._parse_full, text, url, item)
+
+    async def _get_full_limited_async(self, url, item, workers):
+        """Get full page data, limited by `workers` and by `_prefetch_per_host` for the host."""
+        async with workers:
+            if not url:
+                return await self._get_full_async(url, item)
+            # Semaphores are bound to the loop they are used in
+            semaphores = AsyncNewsPostman._async_host_semaphores.setdefault(asyncio.get_event_loop(), {})
+            key = (get_host(url), self._prefetch_per_host)
+            if key not in semaphores:
+                semaphores[key] = asyncio.Semaphore(self._prefetch_per_host)
+            async with semaphores[key]:
+                return await self._get_full_async(url, item)
+
+    async def _real_post_async(self, token, method, data):
+        # https://core.telegram.org/bots/api#sendmessage
+        files = data['files']
+        form = aiohttp.FormData()
+        for key, value in data.items():
+            # As same as requests, skip None fields
+            if key in ('files', 'sources') or value is None:
+                continue
+            form.add_field(key, str(value))
+        for name, f in files.items():
+            form.add_field(name, f, filename=os.path.basename(f.name))
+        try:
+            return await self._request('POST', 'https://api.telegram.org/bot' + token + '/' + method, data=form,
+                                       proxy=self._get_proxy())
+        finally:
+            for f in files.values():
+                f.close()
+
+    def _insert_one_item(self, news_id):
+        # Only buffer here, the buffer is flushed in the executor at the end of the cycle
+        with self._insert_lock:
+            self._insert_buffer.append(str(news_id))
+            if self._posted_cache is not None:
+                self._posted_cache.add([news_id])
+
+    async def _post_async(self, item, news_id):
+        res = None
+        isposted_flags = [0] * len(self._sendList)
+        candidate_list = self._sendList
+
+        # Render once, media are downloaded here
+        message = await self._run_blocking(self._data_format, item, news_id)
+        if message is None:
+            return None
+        data, method = message
+
+        try:
+            for i, chat_id in enumerate(candidate_list):
+                if not chat_id:
+                    continue
+
+                for token in self._TOKENS:
+                    if not token:
+                        continue
+
+                    wait = self._send_scheduler.try_acquire(token, chat_id)
+                    while wait:
+                        await asyncio.sleep(wait)
+                        wait = self._send_scheduler.try_acquire(token, chat_id)
+                    res = await self._real_post_async(token=token, method=method,
+                                                      data=self._address(data, token, chat_id))
+                    self._update_file_ids(token, data, res)
+
+                    action, wait = self._handle_post_response(res, token, chat_id, i, news_id,
+                                                              isposted_flags, candidate_list)
+                    if wait:
+                        await asyncio.sleep(wait)
+                    if action == 'next':
+                        break
+                    if action == 'stop':
+                        return res
+        finally:
+            self._release_files(data)
+        return res
+
+    async def _get_lists_async(self):
+        """Fetch all list urls concurrently, failed urls are reported and counted as empty lists."""
+        results = await asyncio.gather(*(self._get_list_async(self._get_request_url(link), list_url=link)
+                                         for link in self._listURLs), return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors and len(errors) == len(results):
+            raise errors[0]
+
+        list_results = []
+        for link, result in zip(self._listURLs, results):
+            if isinstance(result, BaseException):
+                print('\033[31mwarning in ' + self._tag + ', skip list ' + link + ' in this cycle')
+                print(result)
+                print('\033[0m')
+                list_results.append(([], 0))
+            else:
+                list_results.append(result)
+        return list_results
+
+    async def _action_async(self, no_post=False):  # -> (list, int)
+        self._list_modified = False
+        list_results = await self._get_lists_async()
+
+        unique_list, total = self._select_items(list_results)
+        if unique_list is None:
+            return None, total
+
+        # Unchanged items were handled in former cycles
+        posted = total - len(unique_list)
+        total = 0
+        posted_ids = await self._run_blocking(self._get_posted_ids, [item['id'] for item in unique_list])
+        new_items = []
+        for item in unique_list:
+            if str(item['id']) not in posted_ids:
+                # The same id may appear again in the list, handle it only once
+                posted_ids.add(str(item['id']))
+                new_items.append(item)
+            else:
+                posted += 1
+
+        if no_post:
+            for item in new_items:
+                # to set old news item as POSTED
+                self._insert_one_item(item['id'])
+                print('Get ' + item['id'] + ', but no action!')
+                total += 1
+            new_items = []
+
+        # Fetch full pages in parallel, but post from oldest to newest
+        workers = asyncio.Semaphore(self._prefetch_workers)
+        tasks = [asyncio.ensure_future(self._get_full_limited_async(item['link'], item, workers))
+                 for item in new_items]
+        try:
+            for item, task in zip(new_items, tasks):
+                message = await task
+
+                # Post the message by api
+                try:
+                    res = await self._post_async(message, item['id'])
+                except VideoNotReady as e:
+                    self._defer_item(item['id'], e)
+                    continue
+                if res is None:
+                    print('\033[32m' + str(item['id']) + ' empty message!\033[0m')
+                    continue
+                print('\033[32m' + str(item['id']) + ' ' + str(res.status_code) + '\033[0m')
+                total += 1
+        finally:
+            for task in tasks:
+                task.cancel()
+        await self._run_blocking(self.flush)
+        self._commit_validators()
+        return total, posted
+
+    async def run(self, sleep_time=30, adaptive=None):
+        """
+        Poll in the running event loop until cancelled, as same as `poll` does in a thread.
+
+        :param sleep_time: seconds to sleep after each cycle.
+        :param adaptive: `telegram_news.scheduler.AdaptiveInterval` to learn the sleep time instead.
+        """
+        if aiohttp is None:
+            print('You do not have aiohttp module, please install it by yourself!')
+            return
+        # Boot check
+        if not self._boot_check():
+            return
+        if adaptive:
+            sleep_time = adaptive.interval
+        loop = asyncio.get_event_loop()
+        AsyncNewsPostman._client_runs[loop] = AsyncNewsPostman._client_runs.get(loop, 0) + 1
+        try:
+            await self._run_cycles(sleep_time, adaptive)
+        finally:
+            AsyncNewsPostman._client_runs[loop] -= 1
+            # The last postman running in the loop closes the client session
+            if not AsyncNewsPostman._client_runs[loop]:
+                del AsyncNewsPostman._client_runs[loop]
+                await AsyncNewsPostman.close_client()
+
+    async def _run_cycles(self, sleep_time, adaptive):
+        while True:
+            try:
+                total, posted = await self._action_async()
+                if total is None:
+                    print(self._tag + ':' + ' ' * (6 - len(self._tag)) + '\tList not modified! ' +
+                          str(min(posted, self._max_list_length)) + ' posted. Wait ' +
+                          str(sleep_time) + 's to restart!')
+                else:
+                    print(self._tag + ':' + ' ' * (6 - len(self._tag)) + '\t' + str(total) + ' succeeded, '
+                          + str(posted) + ' posted. Wait ' + str(sleep_time) + 's to restart!')
+                    await self._run_blocking(self._clean_database)
+                if adaptive:
+                    sleep_time = adaptive.update(total or 0)
+            except asyncio.CancelledError:
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print('\033[31mwarning in', self._tag)
+                print(e)
+                print('\033[0m')
+                # Clear cache when any error
+                self._invalidate_cache()
+                self._extractor._cached_list_items = os.urandom(10)
+            except Exception:
+                print('\033[31merror in', self._tag)
+                traceback.print_exc()
+                print('\033[0m')
+                # Clear cache when any error
+                self._invalidate_cache()
+                self._extractor._cached_list_items = os.urandom(10)
+            # Sleep when each loop ended
+            await asyncio.sleep(sleep_time)
+
+
+async def _run_all(postmen, sleep_time):
+    try:
+        await asyncio.gather(*(postman.run(sleep_time) for postman in postmen))
+    finally:
+        await AsyncNewsPostman.close_client()
+
+
+def run_postmen(postmen, sleep_time=30):
+    """
+    Poll many async postmen in one event loop, block until interrupted.
+
+    :param postmen: list of AsyncNewsPostman.
+    :param sleep_time: seconds to sleep between cycles of each postman.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(_run_all(postmen, sleep_time))
+    finally:
+        loop.close()
@@ -8,6 +8,7 @@ class for JSON and XML format data. Maybe have more subclasses for other
 situations.
 """
 
+import atexit
 import hashlib
 import json
 import math
@@ -16,19 +17,54 @@ import random
 import threading
 import traceback
 import warnings
-from time import sleep
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from time import (
+    monotonic,
+    sleep,
+)
 
 import requests
 import sqlalchemy
 from bs4 import BeautifulSoup
 
+from ..attachments import get_attachment_cache
+from ..cache import (
+    FileIdCache,
+    PostedCache,
+    get_file_id,
+)
 from ..displaypolicy import (
     best_effort_display_policy,
     default_id_policy,
 )
-from ..ratelimit import (
-    sleep_and_retry,
-    RateLimitDecorator as limits
+from ..document import (
+    ParsedDocument,
+    compile_selector,
+    get_soup,
+    get_tree,
+    lxml_backend_available,
+    parse_tree,
+)
+from ..listdiff import (
+    ListDiff,
+    unique_items,
+)
+from ..network import (
+    get_host,
+    SessionPool,
+    ValidatorStore,
+    get_validator_store,
+    get_validators,
+)
+from ..ratelimit import SendScheduler
+from ..storage import (
+    BaseStorage,
+    PostgresStorage,
+)
+from ..transcode import (
+    VideoNotReady,
+    get_transcode_key,
 )
 from ..utils import (
     keep_link,
@@ -43,15 +79,26 @@ from ..utils import (
     download_file_by_url,
     get_network_file,
     get_ext_from_url,
+    check_file,
     extract_video_config,
     detect_and_download_video,
     save_compressed_video,
 )
 from ..constant import (
+    MAX_IMAGE_SIZE,
     MAX_VIDEO_SIZE,
     MAX_MEDIA_PER_MEDIAGROUP,
 )
 
+# Postmen alive, their buffered posted ids are written at exit
+_postmen = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_postmen():
+    for postman in list(_postmen):
+        postman.flush()
+
 
 class InfoExtractor(object):
     """
@@ -78,6 +125,7 @@ class InfoExtractor(object):
         _outer_paragraph_selector
         _outer_time_selector
         _outer_source_selector
+        _backend
     """
 
     _listURLs = []
@@ -110,52 +158,98 @@ class InfoExtractor(object):
     _outer_video_selector = None
     _keep_media_link = True
 
-    def __init__(self, lang=''):
+    # 'bs4' selects by BeautifulSoup, 'lxml' by CSS selectors compiled to XPath
+    _backend = 'bs4'
+
+    def __init__(self, lang='', backend='bs4'):
         """Construct the class."""
         self._DEBUG = True
         self._lang = lang
+        self.set_backend(backend)
+
+    def set_backend(self, backend):
+        """
+        Set the parsing and selecting backend.
+
+        :param backend: 'bs4' (default), or 'lxml' to compile selectors once and run them on lxml trees.
+        """
+        if backend not in ('bs4', 'lxml'):
+            raise ValueError('Unknown backend: ' + str(backend))
+        if backend == 'lxml' and not lxml_backend_available():
+            print('You do not have cssselect, please install by yourself! Use bs4 backend instead.')
+            backend = 'bs4'
+        self._backend = backend
+        for name in dir(self):
+            if name.endswith('_selector') and isinstance(getattr(self, name), str):
+                self._compile_selector(getattr(self, name))
+
+    def _compile_selector(self, selector):
+        """Compile the selector for lxml backend, fall back to bs4 if it can not be compiled."""
+        if self._backend == 'lxml' and selector and compile_selector(selector) is None:
+            print('Selector "' + selector + '" is not supported by lxml backend. Use bs4 backend instead.')
+            self._backend = 'bs4'
+
+    def _get_root(self, text):
+        """Get the parse tree of a page by the selected backend."""
+        if self._backend == 'lxml':
+            return get_tree(text)
+        return get_soup(text)
 
     def set_list_selector(self, selector):
         self._list_selector = selector
+        self._compile_selector(selector)
 
     def set_title_selector(self, selector):
         self._title_selector = selector
+        self._compile_selector(selector)
 
     def set_paragraph_selector(self, selector):
         self._paragraph_selector = selector
+        self._compile_selector(selector)
 
     def set_time_selector(self, selector):
         self._time_selector = selector
+        self._compile_selector(selector)
 
     def set_source_selector(self, selector):
         self._source_selector = selector
+        self._compile_selector(selector)
 
     def set_image_selector(self, selector):
         self._image_selector = selector
+        self._compile_selector(selector)
 
     def set_video_selector(self, selector):
         self._video_selector = selector
+        self._compile_selector(selector)
 
     def set_outer_link_selector(self, selector):
         self._outer_link_selector = selector
+        self._compile_selector(selector)
 
     def set_outer_title_selector(self, selector):
         self._outer_title_selector = selector
+        self._compile_selector(selector)
 
     def set_outer_paragraph_selector(self, selector):
         self._outer_paragraph_selector = selector
+        self._compile_selector(selector)
 
     def set_outer_time_selector(self, selector):
         self._outer_time_selector = selector
+        self._compile_selector(selector)
 
     def set_outer_source_selector(self, selector):
         self._outer_source_selector = selector
+        self._compile_selector(selector)
 
     def set_outer_image_selector(self, selector):
         self._outer_image_selector = selector
+        self._compile_selector(selector)
 
     def set_outer_video_selector(self, selector):
         self._outer_video_selector = selector
+        self._compile_selector(selector)
 
     def keep_media_link(self, enable=True):
         self._keep_media_link = enable
@@ -189,6 +283,17 @@ class InfoExtractor(object):
         else:
             return text
 
+    def parse_document(self, text):
+        """
+        Wrap the full page text, so that it is parsed once for all policies.
+
+        :param text: preprocessed text of the full page.
+        :return: ParsedDocument, or `text` itself if it is not a string.
+        """
+        if isinstance(text, str):
+            return ParsedDocument(text)
+        return text
+
     def get_items_policy(self, text, listURL):
         """
         Get all items in the list webpage.
@@ -197,13 +302,20 @@ class InfoExtractor(object):
         :param listURL:
         :return: item dict list.
         """
-        soup = BeautifulSoup(text, 'lxml')
+        soup = self._get_root(text)
         data = soup.select(self._list_selector)
         # print(data)
 
+        # Each entry is moved into this empty document instead of being serialized and parsed
+        # again, so that outer selectors see the same document as a standalone entry page.
+        if self._backend == 'lxml':
+            soup2 = parse_tree('<html><body></body></html>')
+        else:
+            soup2 = BeautifulSoup('<html><body></body></html>', 'lxml')
+
         news_list = []
         for i in data:
-            soup2 = BeautifulSoup(str(i), 'lxml')
+            soup2.body.append(i)
             link_select = soup2.select(self._outer_link_selector)
             link = get_full_link(link_select[0].get('href'), listURL)
             item = {
@@ -267,6 +379,7 @@ class InfoExtractor(object):
             else:
                 item['videos'] = []
             news_list.append(item)
+            i.extract()
 
         return news_list, len(news_list)
 
@@ -283,7 +396,7 @@ class InfoExtractor(object):
                 return keep_link(item['title'].replace('&nbsp;', ' '), item['link'])
         if not self._title_selector:
             return ''
-        soup = BeautifulSoup(text, 'lxml')
+        soup = self._get_root(text)
         title_select = soup.select(self._title_selector)
         try:
             return title_select[0].getText().strip()
@@ -304,7 +417,7 @@ class InfoExtractor(object):
         if not self._paragraph_selector:
             return None
 
-        soup = BeautifulSoup(text, 'lxml')
+        soup = self._get_root(text)
         paragraph_select = soup.select(self._paragraph_selector)
         # print(paragraph_select)
 
@@ -349,7 +462,7 @@ class InfoExtractor(object):
             return item['time']
         if not self._time_selector:
             return ''
-        soup = BeautifulSoup(text, 'lxml')
+        soup = self._get_root(text)
         time_select = soup.select(self._time_selector)
         if not time_select:
             return ""
@@ -368,7 +481,7 @@ class InfoExtractor(object):
             return item['source']
         if not self._source_selector:
             return ''
-        soup = BeautifulSoup(text, 'lxml')
+        soup = self._get_root(text)
         source_select = soup.select(self._source_selector)
         url = item['link']
         try:
@@ -390,7 +503,7 @@ class InfoExtractor(object):
             return item['images']
         if not self._image_selector:
             return []
-        soup = BeautifulSoup(text, 'lxml')
+        soup = self._get_root(text)
         tags_select = soup.select(self._image_selector)
         return get_image_from_select(tags_select, item['link'])
 
@@ -406,7 +519,7 @@ class InfoExtractor(object):
             return item['videos']
         if not self._video_selector:
             return []
-        soup = BeautifulSoup(text, 'lxml')
+        soup = self._get_root(text)
         tags_select = soup.select(self._video_selector)
         return get_video_from_select(tags_select, item['link'])
 
@@ -585,6 +698,7 @@ class NewsPostman(object):
         _parameter_policy
         _TOKENS
         _db
+        _storage
         _table_name
         _max_table_rows
         _list_request_response_encode
@@ -593,7 +707,14 @@ class NewsPostman(object):
         _full_request_timeout
         _max_list_length
         _extractor
-        _cache_list
+        _list_diff
+        _send_scheduler
+        _session_pool
+        _conditional_get
+        _validator_store
+        _posted_cache
+        _insert_batch_size
+        _insert_flush_interval
     """
 
     _listURLs = []
@@ -605,8 +726,13 @@ class NewsPostman(object):
     _parameter_policy = None
     _TOKENS = [os.getenv("TOKEN"), ]
     _db = None
+    _storage = None
     _table_name = None
     _max_table_rows = math.inf
+    _max_table_age = None
+
+    # Rows of a shared table are scoped by source, None for a per-source table
+    _source = None
     _list_request_response_encode = 'utf-8'
     _list_request_timeout = 10
     _full_request_response_encode = 'utf-8'
@@ -622,11 +748,50 @@ class NewsPostman(object):
     _video_detect_verbose = False
     _data_post_process = None
     _max_media_control = MAX_MEDIA_PER_MEDIAGROUP
-    _attach_number = 0
     _attachments_dir = os.path.join(os.getcwd(), 'attachments')
 
-    # Cache the list webpage and check if modified
-    _cache_list = os.urandom(10)
+    # Downloaded attachments are kept by content hash within this budget, shared per directory
+    _attachments_max_bytes = None
+
+    # Videos are compressed in the background if set, otherwise in the polling thread
+    _video_transcoder = None
+
+    # Shared by all postmen, budgets are kept per bot token and per chat
+    _send_scheduler = SendScheduler()
+
+    # Shared by all postmen, connections are kept alive per host
+    _session_pool = SessionPool()
+
+    # Send If-None-Match/If-Modified-Since for list URLs, skip parsing on 304.
+    # Each postman has its own store unless one is given, keys are scoped per postman
+    _conditional_get = True
+    _validator_store = None
+
+    # Posted ids known in memory, loaded from the table on first use, off by default
+    _posted_cache_enabled = False
+    _posted_cache_size = 10000
+    _posted_cache_ttl = None
+    _posted_cache_bloom = True
+    _posted_cache = None
+
+    # File ids of uploaded media per bot token, shared by all postmen
+    _file_id_cache = FileIdCache()
+
+    # Posted ids are inserted in batches, at latest at the end of each cycle
+    _insert_batch_size = 50
+    _insert_flush_interval = 5
+
+    # List urls are fetched in parallel
+    _list_workers = 8
+
+    # Full pages of new items are fetched in parallel, then posted in order
+    _prefetch_workers = 4
+
+    # Media of a media group are downloaded and prepared in parallel
+    _media_workers = 4
+    _prefetch_per_host = 2
+    _host_semaphores = {}
+    _host_semaphores_lock = threading.Lock()
 
     def __init__(self, listURLs, sendList, db, tag='', headers=None, proxies=None,
                  display_policy=best_effort_display_policy):
@@ -636,7 +801,7 @@ class NewsPostman(object):
         self._sendList = sendList
         self._tag = tag
         self._display_policy = display_policy
-        self._db = db
+        self.set_database(db)
         if headers:
             self._headers = headers
         else:
@@ -645,7 +810,24 @@ class NewsPostman(object):
                               'Chrome/80 Safari/537.36'
             }
         self._proxies = proxies
-        self._attach_number = 0
+
+        # Items of the last 200 response and validators not committed yet, by list url
+        self._list_items_cache = {}
+        self._pending_validators = {}
+        self._list_modified = False
+        self._validator_store = ValidatorStore()
+
+        # Fingerprints of seen list items, to handle only new or changed items
+        self._list_diff = ListDiff()
+
+        # Ids of items waiting for their videos, handled again in the next cycle
+        self._deferred_ids = set()
+
+        # Posted ids waiting to be inserted, flushed on size, time, end of cycle and exit
+        self._insert_buffer = []
+        self._insert_buffer_time = None
+        self._insert_lock = threading.RLock()
+        _postmen.add(self)
 
     @staticmethod
     def set_bot_token(new_token):
@@ -657,33 +839,71 @@ class NewsPostman(object):
         NewsPostman._TOKENS.append(new_token)
 
     def set_database(self, db):
+        """
+        Set where posted ids are stored.
+
+        Pass a SQLAlchemy engine or sessionmaker to let every poll thread use
+        its own pooled session, a single session is shared under a lock.
+
+        :param db: a storage from `telegram_news.storage`, or a SQLAlchemy engine,
+            sessionmaker or session for PostgreSQL.
+        """
         self._db = db
+        if db is None or isinstance(db, BaseStorage):
+            self._storage = db
+        else:
+            self._storage = PostgresStorage(db)
+        self._posted_cache = None
+
+    def set_storage(self, storage):
+        """Set the storage of posted ids, as same as `set_database`."""
+        self.set_database(storage)
 
     def set_table_name(self, new_table_name):
         self._table_name = new_table_name
-        rows = self._db.execute("SELECT COUNT(*) FROM information_schema.tables WHERE table_name = :new_table_name ;",
-                                {"new_table_name": new_table_name})
-        if rows.fetchone()[0] == 1:
-            print('Set table name \"' + new_table_name + '\" successfully, table already exists!')
+        self._source = None
+        self._posted_cache = None
+        return self._storage.setup(new_table_name)
+
+    def set_shared_table(self, table_name='news', source=None):
+        """
+        Use a table shared by many sources, create it and its indexes if not exist.
+
+        Rows are scoped by `source`, which is indexed with news id, so checking
+        and cleaning one source never scans rows of others.
+
+        :param table_name: name of the shared table.
+        :param source: source name of this postman, default is the tag.
+        """
+        source = source or self._tag
+        if not source:
+            print('\033[31mShared table needs a source name or a tag!\033[0m')
             return False
-        else:
-            # Change dir to here and change back
-            work_path = os.getcwd()
-            file_path = os.path.abspath(__file__).replace('common.py', '')
-            os.chdir(file_path)
-            f = open("../table.sql")
-            os.chdir(work_path)
-
-            # Get SQL statement
-            lines = f.read()
-            f.close()
-
-            lines = lines.replace(' ' + 'news' + '\n', ' ' + new_table_name + '\n')
-            print('New table name \"' + new_table_name + '\" is settable, setting...')
-            self._db.execute(lines)
-            self._db.commit()
-            print('Create table finished!')
-            return True
+        self._table_name = table_name
+        self._source = source
+        self._posted_cache = None
+        self._storage.setup(table_name, shared=True)
+        return True
+
+    def migrate_table(self, old_table_name, drop=False):
+        """
+        Copy posted ids from a per-source table created by `set_table_name` to the shared table.
+
+        Ids already in the shared table are skipped, so it is safe to run again.
+
+        :param old_table_name: name of the per-source table.
+        :param drop: drop the old table after copying.
+        :return: number of copied rows.
+        """
+        if self._source is None:
+            print('\033[31mCall set_shared_table before migrating ' + old_table_name + '!\033[0m')
+            return 0
+        self.flush()
+        number = self._storage.migrate(old_table_name, self._table_name, self._source, drop=drop)
+        self._posted_cache = None
+        print('Migrate ' + str(number) + ' rows from \"' + old_table_name + '\" to \"' +
+              self._table_name + '\" finished!')
+        return number
 
     def set_max_table_rows(self, num, verbose=True):
         if verbose:
@@ -691,27 +911,88 @@ class NewsPostman(object):
             print('And to avoid problems caused by unstable list, the number may be higher!')
         self._max_table_rows = num
 
+    def set_max_table_age(self, seconds):
+        """
+        Delete rows older than `seconds` when cleaning database, None to keep them.
+
+        Keep it much longer than an item may stay in the list.
+        """
+        self._max_table_age = seconds
+
     def _clean_database(self):
-        query = "SELECT COUNT(*) FROM {}".format(self._table_name)
-        rows = self._db.execute(query)
-        # If the items in database exceed 2 of 3 of max rows, begin to delete old 1 of 3 of max rows
-        rows_num = rows.fetchone()[0]
-        # print("rows: ", rows_num)
-
-        if rows_num > 2 * ((self._max_table_rows - 3) / 3):
-            delete_number = int(self._max_table_rows / 3)
-            print('delete ', delete_number)
-            query = "DELETE FROM {} WHERE id IN ( SELECT id FROM {} ORDER BY id ASC LIMIT :delete_number )" \
-                .format(self._table_name, self._table_name)
-            self._db.execute(query, {"delete_number": str(delete_number)})
-            self._db.commit()
+        deleted = self._storage.clean(self._table_name, self._source,
+                                      max_rows=self._max_table_rows, max_age=self._max_table_age)
+        if deleted:
+            if self._posted_cache is not None:
+                self._posted_cache.discard(deleted)
             print('\033[33mClean database finished!\033[0m')
 
     def _insert_one_item(self, news_id):
-        query = "INSERT INTO {} (news_id, time) VALUES (:news_id, NOW())".format(self._table_name)
-        self._db.execute(query, {"news_id": news_id})
-        # Commit changes to database
-        self._db.commit()
+        with self._insert_lock:
+            if not self._insert_buffer:
+                self._insert_buffer_time = monotonic()
+            self._insert_buffer.append(str(news_id))
+            if self._posted_cache is not None:
+                self._posted_cache.add([news_id])
+            if len(self._insert_buffer) >= self._insert_batch_size or \
+                    monotonic() - self._insert_buffer_time >= self._insert_flush_interval:
+                self.flush()
+
+    def flush(self):
+        """Insert all buffered posted ids in one transaction."""
+        with self._insert_lock:
+            if not self._insert_buffer:
+                return
+            self._storage.insert(self._table_name, self._source, self._insert_buffer)
+            self._insert_buffer = []
+            self._insert_buffer_time = None
+
+    def set_insert_batch(self, batch_size=50, flush_interval=5):
+        """
+        Set when buffered posted ids are written to database.
+
+        Buffered ids are also written before each cycle checks ids and at the
+        end of each cycle, so after a crash only ids posted in the running
+        cycle can be posted again. Set `batch_size` to 1 to write each id at once.
+
+        :param batch_size: write when this number of ids are buffered.
+        :param flush_interval: write when the oldest buffered id waited this number of seconds.
+        """
+        self._insert_batch_size = batch_size
+        self._insert_flush_interval = flush_interval
+
+    def enable_posted_cache(self, enable=True, max_size=10000, ttl=None, bloom=True):
+        """
+        Keep posted ids in memory, so that known ids are not checked by database again.
+
+        Only for a table written by this postman alone: with the Bloom filter, ids missing in
+        memory are taken as not posted, so ids written by other postmen or processes would be
+        posted again. In a shared table, missing ids are always checked by database.
+
+        :param enable: set False to check every id by database.
+        :param max_size: max ids kept, least recently used ids are evicted.
+        :param ttl: seconds an id is trusted before it is checked again, None for no limit.
+        :param bloom: use a Bloom filter of all ids in the table, to skip checking new ids.
+        """
+        self._posted_cache_enabled = enable
+        self._posted_cache_size = max_size
+        self._posted_cache_ttl = ttl
+        self._posted_cache_bloom = bloom
+        self._posted_cache = None
+
+    def _get_posted_cache(self):
+        """Get the posted id cache, load it from the table on first use."""
+        if not self._posted_cache_enabled:
+            return None
+        if self._posted_cache is None:
+            news_ids = self._storage.load_ids(self._table_name, self._source)
+            bloom_capacity = max(2 * len(news_ids), self._posted_cache_size) if self._posted_cache_bloom else None
+            cache = PostedCache(max_size=self._posted_cache_size, ttl=self._posted_cache_ttl,
+                                bloom_capacity=bloom_capacity)
+            # Other sources write a shared table too, never trust misses there
+            cache.load(news_ids, complete=self._source is None)
+            self._posted_cache = cache
+        return self._posted_cache
 
     def not_post_old(self):
         """Use the same work logic to set old news item as POSTED."""
@@ -741,9 +1022,19 @@ class NewsPostman(object):
     def enable_auto_retry(self, enable=True):
         self._auto_retry = enable
 
-    def enable_download_and_send(self, enable=True, attachments_dir=None):
+    def enable_download_and_send(self, enable=True, attachments_dir=None, max_bytes=None):
+        """
+        Download media and upload them, instead of sending their urls.
+
+        :param enable: set False to send urls.
+        :param attachments_dir: directory of downloaded media.
+        :param max_bytes: max bytes of the directory, shared by postmen using it. Least recently
+                          used files are deleted, default is 2GB.
+        """
         if attachments_dir:
             self._attachments_dir = attachments_dir
+        if max_bytes:
+            self._attachments_max_bytes = max_bytes
         if enable:
             print('Attachments will be downloaded to', self._attachments_dir)
         self._download_and_send = enable
@@ -767,12 +1058,77 @@ class NewsPostman(object):
             warnings.warn('Enable video compression failed! You must enable download_and_send first!', stacklevel=2)
             exit(1)
 
+    def set_video_transcoder(self, transcoder):
+        """
+        Compress videos by a `telegram_news.transcode.VideoTranscoder`, in worker processes.
+
+        Items are still posted from oldest to newest in each cycle, but an item whose video
+        is being compressed is skipped and tried again in the next cycles.
+
+        :param transcoder: VideoTranscoder, maybe shared by postmen. None to compress in the polling thread.
+        """
+        self._video_transcoder = transcoder
+
     def set_data_post_process(self, data_post_process):
         self._data_post_process = data_post_process
 
     def set_max_media_number(self, number):
+        """Set media kept of an item with more than MAX_MEDIA_PER_MEDIAGROUP media, None to keep all."""
         self._max_media_control = number
 
+    def set_list_workers(self, workers=8):
+        """Set max list urls fetched at the same time, 1 to fetch them one by one."""
+        self._list_workers = max(1, workers)
+
+    def set_prefetch(self, workers=4, per_host=2):
+        """
+        Set how full pages of new items are fetched before posting.
+
+        Items are still posted from oldest to newest. Set `workers` to 1 to
+        fetch one page at a time.
+
+        :param workers: max pages fetched at the same time by this postman.
+        :param per_host: max pages fetched at the same time from one host, shared by all postmen.
+        """
+        self._prefetch_workers = max(1, workers)
+        self._prefetch_per_host = max(1, per_host)
+
+    def set_media_workers(self, workers=4):
+        """Set max media of a media group prepared at the same time, 1 to prepare them one by one."""
+        self._media_workers = max(1, workers)
+
+    def enable_file_id_cache(self, enable=True, max_size=10000):
+        """
+        Send media by the file id Telegram returned for the first upload, instead of uploading it again.
+
+        File ids only work for the bot that uploaded the media, so each bot
+        token uploads a media once.
+
+        :param enable: set False to upload or send the url every time.
+        :param max_size: max file ids kept for this postman, least recently used ones are evicted.
+        """
+        self._file_id_cache = FileIdCache(max_size) if enable else None
+
+    def set_send_scheduler(self, send_scheduler):
+        self._send_scheduler = send_scheduler
+
+    def set_session_pool(self, session_pool):
+        self._session_pool = session_pool
+
+    def enable_conditional_get(self, enable=True, validator_store=None):
+        """
+        Send conditional requests for list URLs.
+
+        :param enable: set False to always download and parse list pages.
+        :param validator_store: ValidatorStore, or a JSON file path to keep validators after restart.
+            A store can be shared by postmen, validators are kept by table, source (or tag) and list url.
+        """
+        self._conditional_get = enable
+        if isinstance(validator_store, str):
+            validator_store = get_validator_store(validator_store)
+        if validator_store is not None:
+            self._validator_store = validator_store
+
     def set_parameter_policy(self, parameter_policy):
         self._parameter_policy = parameter_policy
 
@@ -782,28 +1138,104 @@ class NewsPostman(object):
         else:
             return pure_url
 
-    def _get_list(self, list_request_url):  # -> (list, int)
+    def _get_list(self, list_request_url, list_url=None):  # -> (list, int)
         timeout = self._list_request_timeout
-        res = requests.get(list_request_url, headers=self._headers, timeout=timeout)
+        list_url = list_url or list_request_url
+        res = self._session_pool.get(list_request_url, headers=self._get_list_headers(list_url), timeout=timeout)
         # print(res.text)
+        return self._handle_list_response(res, list_request_url, list_url)
+
+    def _get_list_headers(self, list_url):
+        """Get request headers for a list url, with cache validators if conditional requests are enabled."""
+        if self._conditional_get and not self._disable_cache:
+            return dict(self._headers or {}, **self._validator_store.get(self._get_validator_key(list_url)))
+        return self._headers
+
+    def _get_validator_key(self, list_url):
+        """Key of validators of a list url, postmen polling the same url must not use the validators of each other."""
+        return json.dumps([self._table_name, self._source or self._tag, list_url])
+
+    def _handle_list_response(self, res, list_request_url, list_url):  # -> (list, int)
+        """Parse items from a list response, or reuse the last items if not modified."""
+        conditional = self._conditional_get and not self._disable_cache
+        if res.status_code == 304:
+            # Not modified, reuse items parsed from the last response. After restart, there are
+            # no such items, but validators are only stored when all items have been handled.
+            return self._list_items_cache.get(list_url, ([], 0))
         if res.status_code == 200:
+            self._list_modified = True
             res.encoding = self._list_request_response_encode
             text = self._extractor.list_pre_process(res.text, list_request_url)
-            return self._extractor.get_items_policy(text, list_request_url)
+            items = self._extractor.get_items_policy(text, list_request_url)
+            if conditional:
+                validators = get_validators(res)
+                self._list_items_cache[list_url] = items
+                if validators:
+                    self._pending_validators[self._get_validator_key(list_url)] = validators
+            return items
         else:
+            self._list_modified = True
             print('\033[31mList URL error exception in ' + self._tag + '! ' + str(res.status_code) + '\033[0m')
             if res.status_code == 403:
                 print('Maybe something not work.')
             return [], 0
 
+    def _commit_validators(self):
+        """Remember validators only after the items of the cycle have been handled."""
+        self._validator_store.update(self._pending_validators)
+        self._pending_validators = {}
+
+    def _invalidate_cache(self):
+        """Make the next cycle download and process all lists again."""
+        self._list_diff.clear()
+        self._pending_validators = {}
+        self._list_items_cache = {}
+        self._validator_store.discard([self._get_validator_key(list_url) for list_url in self._listURLs])
+
     def _get_full(self, url, item):
         text = ""
         if url:
             timeout = self._full_request_timeout
-            res = requests.get(url, headers=self._headers, timeout=timeout)
+            res = self._session_pool.get(url, headers=self._headers, timeout=timeout)
             res.encoding = self._full_request_response_encode
             text = res.text
+        return self._parse_full(text, url, item)
+
+    def _get_host_semaphore(self, url):
+        # Postmen with the same limit share the semaphore of a host
+        key = (get_host(url), self._prefetch_per_host)
+        with NewsPostman._host_semaphores_lock:
+            if key not in NewsPostman._host_semaphores:
+                NewsPostman._host_semaphores[key] = threading.BoundedSemaphore(self._prefetch_per_host)
+            return NewsPostman._host_semaphores[key]
+
+    def _get_full_limited(self, url, item):
+        """Get full page data, with at most `_prefetch_per_host` requests to the same host."""
+        if not url:
+            return self._get_full(url, item=item)
+        with self._get_host_semaphore(url):
+            return self._get_full(url, item=item)
+
+    def _prefetch_full(self, items):
+        """
+        Fetch and extract full pages of `items` in parallel.
+
+        :param items: items to fetch, from oldest to newest.
+        :return: list of results in the order of `items`, as functions returning
+            the data or raising the error of fetching.
+        """
+        if self._prefetch_workers <= 1 or len(items) <= 1:
+            return [lambda item=item: self._get_full(item['link'], item=item) for item in items]
+        executor = ThreadPoolExecutor(max_workers=min(self._prefetch_workers, len(items)))
+        futures = [executor.submit(self._get_full_limited, item['link'], item) for item in items]
+        # Threads exit when all futures are done, do not wait for them here
+        executor.shutdown(wait=False)
+        return [future.result for future in futures]
+
+    def _parse_full(self, text, url, item):
+        """Extract message data from the text of a full page."""
         text = self._extractor.full_pre_process(text, item['link'])
+        text = self._extractor.parse_document(text)
         # print(text)
 
         title = self._extractor.get_title_policy(text, item)
@@ -852,83 +1284,136 @@ class NewsPostman(object):
         """
         Prepare video file and video name for sending.
         It will change the value of `data`, without returning!
+
+        Files to send are pinned in the attachment cache, release them by `_release_files`.
         """
 
         files_to_send = {}
 
-        if self._attach_number > MAX_MEDIA_PER_MEDIAGROUP:
-            return None, '', 0, 0, 0, files_to_send
-        self._attach_number += 1
+        # Sent by all bots before, `_address` sends the file ids instead
+        if self._download_and_send and self._known_by_all_bots(url):
+            return url, '', 0, 0, 0, files_to_send
 
+        source = url
         if self._auto_retry:
             url = add_parameters_into_url(url, {str(os.urandom(1)): str(os.urandom(1))})
 
         if self._download_and_send:
-            if not os.path.exists(self._attachments_dir):
-                os.mkdir(self._attachments_dir)
-
-            video_name = hashlib.md5(url.encode('utf-8')).hexdigest() + get_ext_from_url(url)
-            thumb_name = hashlib.md5(url.encode('utf-8')).hexdigest() + '.jpg'
-            video_full_path = os.path.join(self._attachments_dir, video_name)
-            thumb_full_path = os.path.join(self._attachments_dir, thumb_name)
-
-            # If not a local file path, download it
-            if not os.path.exists(url):
-                print('Downloading video:', url)
-                download_file_by_url(url, video_full_path, header=self._headers)
-            # If the file was downloaded:
-            else:
-                video_name = os.path.basename(url)
-                thumb_name = video_name.split('.')[-2] + '.jpg'
-                video_full_path = os.path.join(self._attachments_dir, video_name)
-                thumb_full_path = os.path.join(self._attachments_dir, thumb_name)
-
-            if self._compress_video:
-                # Compress video, but use `video_name` as its name.
-                new_video_full_path = save_compressed_video(video_full_path, MAX_VIDEO_SIZE)
-                if new_video_full_path:
-                    video_full_path = new_video_full_path
-                else:   # Compress video failed, discard it.
-                    return None, '', 0, 0, 0, files_to_send
+            cache = self._get_attachment_cache()
+            # Files pinned but not sent are unpinned at the end
+            pinned = []
             try:
-                files_to_send[video_name] = open(video_full_path, 'rb')
-                extracted_thumb_name, duration, width, height = extract_video_config(video_full_path, thumb_full_path, thumb_name)
-
-                if extracted_thumb_name:
-                    files_to_send[extracted_thumb_name] = open(thumb_full_path, 'rb')
-                    return f'attach://{video_name}', f'attach://{extracted_thumb_name}', duration, width, height, files_to_send
-            except FileNotFoundError as e:
-                print('Video file not found:', video_full_path)
-                if self._mute_download_warnings:
-                    return None, '', 0, 0, 0, files_to_send
+                # If not a local file path, download it
+                if not os.path.exists(url):
+                    video_full_path = cache.get(source, pin=True)
+                    if video_full_path is None:
+                        video_full_path = os.path.join(self._attachments_dir,
+                                                       hashlib.md5(url.encode('utf-8')).hexdigest() +
+                                                       get_ext_from_url(url))
+                        print('Downloading video:', url)
+                        # Compression makes large videos fit, otherwise they can not be sent
+                        max_size = None if self._compress_video else MAX_VIDEO_SIZE
+                        download_file_by_url(url, video_full_path, header=self._headers, session=self._session_pool,
+                                             max_size=max_size)
+                        if os.path.isfile(video_full_path):
+                            video_full_path = cache.add(source, video_full_path, pin=True)
+                            pinned.append(video_full_path)
+                    else:
+                        pinned.append(video_full_path)
+                # If the file was downloaded:
                 else:
-                    raise e
+                    video_full_path = cache.add(None, url, pin=True)
+                    pinned.append(video_full_path)
+
+                if self._compress_video and self._video_transcoder is not None and os.path.isfile(video_full_path):
+                    # Transcode in the background, the item is tried again in a later cycle
+                    job = self._video_transcoder.submit(cache, video_full_path, MAX_VIDEO_SIZE)
+                    if job.done() and job.output and job.output != video_full_path:
+                        new_video_full_path = cache.get(job.key, pin=True)
+                        if new_video_full_path is None:
+                            # Evicted after transcoding, do it again
+                            job = self._video_transcoder.submit(cache, video_full_path, MAX_VIDEO_SIZE)
+                        else:
+                            pinned.append(new_video_full_path)
+                            video_full_path = new_video_full_path
+                    if not job.done():
+                        raise VideoNotReady(job)
+                    if not job.output:   # Compress video failed, discard it.
+                        return None, '', 0, 0, 0, files_to_send
+                elif self._compress_video:
+                    # Compressed outputs are cached by the content of the video and the target size
+                    compressed_key = get_transcode_key(video_full_path, MAX_VIDEO_SIZE)
+                    new_video_full_path = cache.get(compressed_key, pin=True)
+                    if new_video_full_path is None:
+                        new_video_full_path = save_compressed_video(video_full_path, MAX_VIDEO_SIZE)
+                        if new_video_full_path and new_video_full_path != video_full_path:
+                            new_video_full_path = cache.add(compressed_key, new_video_full_path, pin=True)
+                            pinned.append(new_video_full_path)
+                    else:
+                        pinned.append(new_video_full_path)
+                    if new_video_full_path:
+                        video_full_path = new_video_full_path
+                    else:   # Compress video failed, discard it.
+                        return None, '', 0, 0, 0, files_to_send
+                video_name = os.path.basename(video_full_path)
+                thumb_name = os.path.splitext(video_name)[0] + '.jpg'
+                thumb_full_path = os.path.join(self._attachments_dir, thumb_name)
+                try:
+                    files_to_send[video_name] = check_file(video_full_path)
+                    extracted_thumb_name, duration, width, height = extract_video_config(video_full_path, thumb_full_path, thumb_name)
+
+                    if extracted_thumb_name:
+                        thumb_full_path = cache.add(None, check_file(thumb_full_path), pin=True)
+                        pinned.append(thumb_full_path)
+                        extracted_thumb_name = os.path.basename(thumb_full_path)
+                        files_to_send[extracted_thumb_name] = thumb_full_path
+                        return f'attach://{video_name}', f'attach://{extracted_thumb_name}', duration, width, height, files_to_send
+                except FileNotFoundError as e:
+                    print('Video file not found:', video_full_path)
+                    files_to_send.clear()
+                    if self._mute_download_warnings:
+                        return None, '', 0, 0, 0, files_to_send
+                    else:
+                        raise e
 
-            return f'attach://{video_name}', '', duration, width, height, files_to_send
+                return f'attach://{video_name}', '', duration, width, height, files_to_send
+            finally:
+                sent = list(files_to_send.values())
+                for path in sent:
+                    if path in pinned:
+                        pinned.remove(path)
+                cache.unpin(pinned)
 
         return url, '', 0, 0, 0, files_to_send
 
     def _photo_send_policy(self, url):
+        """Files to send are pinned in the attachment cache, release them by `_release_files`."""
         files_to_send = {}
 
-        if self._attach_number > MAX_MEDIA_PER_MEDIAGROUP:
-            return None, files_to_send
-        self._attach_number += 1
+        # Sent by all bots before, `_address` sends the file ids instead
+        if self._download_and_send and self._known_by_all_bots(url):
+            return url, files_to_send
 
+        source = url
         if self._auto_retry:
             url = add_parameters_into_url(url, {str(os.urandom(1)): str(os.urandom(1))})
         if self._download_and_send:
-            if not os.path.exists(self._attachments_dir):
-                os.mkdir(self._attachments_dir)
-
-            photo_name = hashlib.md5(url.encode('utf-8')).hexdigest() + get_ext_from_url(url)
-            photo_full_path = os.path.join(self._attachments_dir, photo_name)
-
-            print('Downloading photo:', url)
-            download_file_by_url(url, photo_full_path, header=self._headers)
+            cache = self._get_attachment_cache()
+            photo_full_path = cache.get(source, pin=True)
+            if photo_full_path is None:
+                photo_full_path = os.path.join(self._attachments_dir,
+                                               hashlib.md5(url.encode('utf-8')).hexdigest() + get_ext_from_url(url))
+                print('Downloading photo:', url)
+                download_file_by_url(url, photo_full_path, header=self._headers, session=self._session_pool,
+                                     max_size=MAX_IMAGE_SIZE)
+                if os.path.isfile(photo_full_path):
+                    photo_full_path = cache.add(source, photo_full_path, pin=True)
+            photo_name = os.path.basename(photo_full_path)
             try:
-                files_to_send[photo_name] = open(photo_full_path, 'rb')
+                files_to_send[photo_name] = check_file(photo_full_path)
             except FileNotFoundError as e:
+                # Not pinned if it was not cached, unpinning it does nothing
+                cache.unpin([photo_full_path])
                 print('Download failed:', url)
                 if self._mute_download_warnings:
                     return None, files_to_send
@@ -938,7 +1423,59 @@ class NewsPostman(object):
 
         return url, files_to_send
 
+    def _prepare_media(self, images, videos):
+        """
+        Prepare media of a media group in parallel, by `_photo_send_policy` and `_video_send_policy`.
+
+        Telegram API returns 400 if a media group has more than MAX_MEDIA_PER_MEDIAGROUP media,
+        so if there are more, only the first `set_max_media_number` ones are prepared.
+
+        :return: list of (media type, url, result of the policy), images first, in the original order.
+        """
+        policies = {'photo': self._photo_send_policy, 'video': self._video_send_policy}
+        media_list = [('photo', url) for url in images] + [('video', url) for url in videos]
+        if len(media_list) > MAX_MEDIA_PER_MEDIAGROUP and self._max_media_control:
+            media_list = media_list[:self._max_media_control]
+
+        if self._media_workers <= 1 or len(media_list) <= 1:
+            results = []
+            try:
+                for media_type, url in media_list:
+                    results.append((media_type, url, policies[media_type](url)))
+            except BaseException:
+                # Files of prepared media are not sent
+                self._get_attachment_cache().unpin([path for result in results for path in result[2][-1].values()])
+                raise
+            return results
+        with ThreadPoolExecutor(max_workers=min(self._media_workers, len(media_list))) as executor:
+            futures = [executor.submit(policies[media_type], url) for media_type, url in media_list]
+        errors = [future.exception() for future in futures]
+        if any(errors):
+            # Files of prepared media are not sent
+            self._get_attachment_cache().unpin([path for future, error in zip(futures, errors) if not error
+                                                for path in future.result()[-1].values()])
+            raise next(error for error in errors if error)
+        return [(media_type, url, future.result()) for (media_type, url), future in zip(media_list, futures)]
+
+    def _add_files(self, data, files_to_send):
+        """Add pinned files of a media to the message, a file already in it is pinned once only."""
+        for name, path in files_to_send.items():
+            if name in data['files']:
+                self._get_attachment_cache().unpin([path])
+            else:
+                data['files'][name] = path
+
+    def _get_attachment_cache(self):
+        return get_attachment_cache(self._attachments_dir, self._attachments_max_bytes)
+
     def _data_format(self, item, news_id):
+        """
+        Render an item into a message once, for all chats and bots.
+
+        Files are given by path and opened by `_address` for each sending.
+
+        :return: (data, method), or None if the message is empty.
+        """
 
         # Get display policy by "item" information
         data = self._display_policy(item, max_len=self._extractor.max_post_length)
@@ -965,27 +1502,34 @@ class NewsPostman(object):
                 method = 'sendPhoto'
                 data['caption'] = data.pop('text')
                 data['photo'], files_to_send = self._photo_send_policy(item['images'][0])
-                data['files'].update(files_to_send)
+                self._add_files(data, files_to_send)
+                data['sources'] = [item['images'][0]]
             elif len(item['images']) == 0 and len(item['videos']) == 1:
                 method = 'sendVideo'
                 data['caption'] = data.pop('text')
                 data['video'], data['thumb'], data['duration'], data['width'], data['height'], files_to_send = self._video_send_policy(item['videos'][0])
-                data['files'].update(files_to_send)
+                self._add_files(data, files_to_send)
+                data['sources'] = [item['videos'][0]]
                 data['supports_streaming'] = True
             else:
                 method = 'sendMediaGroup'
                 data['media'] = []
-                for image in item['images']:
-                    photo, files_to_send = self._photo_send_policy(image)
+                data['sources'] = []
+                for media_type, source, result in self._prepare_media(item['images'], item['videos']):
+                    if media_type == 'photo':
+                        photo, files_to_send = result
+
+                        if photo:
+                            self._add_files(data, files_to_send)
+                            data['sources'].append(source)
+                            data['media'].append({'type': 'photo', 'media': photo})
+                        continue
 
-                    if photo:
-                        data['files'].update(files_to_send)
-                        data['media'].append({'type': 'photo', 'media': photo})
-                for video in item['videos']:
-                    media, thumb, duration, width, height, files_to_send = self._video_send_policy(video)
+                    media, thumb, duration, width, height, files_to_send = result
 
                     if media:
-                        data['files'].update(files_to_send)
+                        self._add_files(data, files_to_send)
+                        data['sources'].append(source)
                         data['media'].append({
                             'type': 'video',
                             'media': media,
@@ -998,228 +1542,454 @@ class NewsPostman(object):
 
                 # Degrade to sendMessage
                 if len(data['media']) == 0:
+                    del data['media'], data['sources']
                     return data, 'sendMessage'
 
                 data['media'][0]['caption'] = data.pop('text')
                 data['media'][0]['parse_mode'] = data.pop('parse_mode')
 
-                # Telegram API return 400 if media length is greater than MAX_MEDIA_PER_MEDIAGROUP
-                if len(data['media']) > MAX_MEDIA_PER_MEDIAGROUP and self._max_media_control:
-                    data['media'] = data['media'][0: self._max_media_control]
-
-                # Telegram API can't parse media JSON object
-                data['media'] = json.dumps(data['media'])
         else:
             method = 'sendMessage'
             text_name = 'text'  # Max length = 4096
 
-        self._attach_number = 0
         if self._DEBUG:
             print(data)
         return data, method
 
-    @sleep_and_retry
-    @limits(calls=1, period=1)
     def _real_post(self, token, method, data):
         # https://core.telegram.org/bots/api#sendmessage
-        res = requests.post('https://api.telegram.org/bot' + token + '/' + method, data, files=data['files'], proxies=self._proxies)
+        payload = {key: value for key, value in data.items() if key not in ('files', 'sources')}
+        res = self._session_pool.post('https://api.telegram.org/bot' + token + '/' + method, payload,
+                                      files=data['files'], proxies=self._proxies)
         return res
 
+    def _address(self, data, token, chat_id):
+        """
+        Make the request of a rendered message for one chat and bot, without changing the message.
+
+        Media sent by the bot before are replaced by their file ids, and only
+        files still attached are opened. Close them after sending.
+
+        :return: request data, with open files in `files`.
+        """
+        request = {key: value for key, value in data.items() if key not in ('files', 'sources')}
+        request['chat_id'] = chat_id
+        sources = data.get('sources') or []
+        fields = [request]
+        if 'media' in request:
+            fields = [dict(entry) for entry in request['media']]
+            for entry, source in zip(fields, sources):
+                file_id = self._get_cached_file_id(token, source)
+                if file_id:
+                    entry['media'] = file_id
+                    if 'thumb' in entry:
+                        entry['thumb'] = ''
+            # Telegram API can't parse media JSON object
+            request['media'] = json.dumps(fields)
+        elif sources:
+            file_id = self._get_cached_file_id(token, sources[0])
+            if file_id:
+                request['photo' if 'photo' in request else 'video'] = file_id
+                if 'thumb' in request:
+                    request['thumb'] = ''
+
+        attached = set()
+        for field in fields:
+            for key in ('photo', 'video', 'media', 'thumb'):
+                value = field.get(key)
+                if isinstance(value, str) and value.startswith('attach://'):
+                    attached.add(value[len('attach://'):])
+        request['files'] = {name: open(path, 'rb') for name, path in data['files'].items() if name in attached}
+        return request
+
+    def _get_cached_file_id(self, token, source):
+        if token is None or self._file_id_cache is None:
+            return None
+        return self._file_id_cache.get(token, source)
+
+    def _known_by_all_bots(self, source):
+        """Check if every bot token has a file id of the media, so it needs no download."""
+        tokens = [token for token in self._TOKENS if token]
+        return bool(tokens) and all(self._get_cached_file_id(token, source) for token in tokens)
+
+    def _update_file_ids(self, token, data, res):
+        """Remember file ids of media in a successful response, for later sending by the same bot."""
+        if self._file_id_cache is None or not data.get('sources'):
+            return
+        if res.status_code == 400:
+            # Maybe a file id is not valid any more, upload the media next time
+            for source in data['sources']:
+                self._file_id_cache.discard(token, source)
+            return
+        if res.status_code != 200:
+            return
+        try:
+            result = json.loads(res.text)['result']
+        except (ValueError, KeyError, TypeError):
+            return
+        # sendMediaGroup returns messages in the order of media
+        messages = result if isinstance(result, list) else [result]
+        for source, message in zip(data['sources'], messages):
+            file_id = get_file_id(message)
+            if file_id:
+                self._file_id_cache.set(token, source, file_id)
+
     def _post(self, item, news_id):
 
         res = None
         isposted_flags = [0] * len(self._sendList)
         candidate_list = self._sendList
 
-        for i, chat_id in enumerate(candidate_list):
-            if not chat_id:
-                continue
+        # Render once, only the chat and the bot change for each sending
+        message = self._data_format(item, news_id)
+        if message is None:
+            return None
+        data, method = message
 
-            for token in self._TOKENS:
-                if not token:
+        try:
+            for i, chat_id in enumerate(candidate_list):
+                if not chat_id:
                     continue
 
-                # Get formatted sending data
-                # Reopen files for each sending
-                data, method = self._data_format(item, news_id)
+                for token in self._TOKENS:
+                    if not token:
+                        continue
 
-                data['chat_id'] = chat_id
+                    request = self._address(data, token, chat_id)
+                    try:
+                        self._send_scheduler.acquire(token, chat_id)
+                        res = self._real_post(token=token, method=method, data=request)
+                    finally:
+                        for f in request['files'].values():
+                            f.close()
+                    self._update_file_ids(token, data, res)
+
+                    action, wait = self._handle_post_response(res, token, chat_id, i, news_id,
+                                                              isposted_flags, candidate_list)
+                    if wait:
+                        # Sleep time is determined by the last bot!
+                        sleep(wait)
+                    if action == 'next':
+                        break
+                    if action == 'stop':
+                        return res
+        finally:
+            self._release_files(data)
+        return res
 
-                res = self._real_post(token=token, method=method, data=data)
+    def _release_files(self, data):
+        """Let files of a sent message be evicted from the attachment cache."""
+        if data['files']:
+            self._get_attachment_cache().unpin(data['files'].values())
 
-                # If post successfully, record and post to next channel.
-                if res.status_code == 200:
-                    isposted_flags[i] = 1
+    def _handle_post_response(self, res, token, chat_id, i, news_id, isposted_flags, candidate_list):
+        """
+        Check the response of one sending, record the item and update flags.
 
-                    # Only record once when successfully posted.
-                    if isposted_flags.count(1) == 1:
-                        self._insert_one_item(news_id)
+        :return: (action, seconds to sleep), action is 'next' to post to next chat,
+            'retry' to go on with next bot token, 'stop' to give up the item.
+        """
+        # If post successfully, record and post to next channel.
+        if res.status_code == 200:
+            isposted_flags[i] = 1
 
-                    break
+            # Only record once when successfully posted.
+            if isposted_flags.count(1) == 1:
+                self._insert_one_item(news_id)
 
-                # If not success because of 429 error, retry by other bots.
-                elif res.status_code == 429:
+            return 'next', 0
 
-                    # If no more bot tokens for retrying.
-                    if token is self._TOKENS[-1]:
-                        print('\033[31mWarning! 429 happened in ' + self._tag + '!\033[0m')
+        # If not success because of 429 error, retry by other bots.
+        elif res.status_code == 429:
+            retry_after = json.loads(res.text).get('parameters', {}).get('retry_after', 1)
+            self._send_scheduler.backoff(token, chat_id, retry_after)
 
-                        # Sleep time is determined by the last bot!
-                        sleep_time = json.loads(res.text)['parameters']['retry_after']
-                        sleep(sleep_time)
+            # If no more bot tokens for retrying.
+            if token is self._TOKENS[-1]:
+                print('\033[31mWarning! 429 happened in ' + self._tag + '!\033[0m')
 
-                        # Clear cache if not post.
-                        self._cache_list = os.urandom(10)
+                # Clear cache if not post.
+                self._invalidate_cache()
 
-                        # The last post succeed but this one failed, do it again!
-                        if isposted_flags[i] == 0 and i != 0 and isposted_flags[:i].count(1) >= 1:
-                            candidate_list.append(chat_id)
-                            isposted_flags.append(0)
-                            continue
+                # The last post succeed but this one failed, do it again!
+                if isposted_flags[i] == 0 and i != 0 and isposted_flags[:i].count(1) >= 1:
+                    candidate_list.append(chat_id)
+                    isposted_flags.append(0)
+                    return 'retry', retry_after
 
-                        # Non-first channel has the risk of lost message
-                        return res
-                    else:
-                        print("Retry " + str(self._TOKENS.index(token) + 1) + " time(s) for " + self._tag)
-                        continue
+                # Non-first channel has the risk of lost message
+                return 'stop', retry_after
+            else:
+                print("Retry " + str(self._TOKENS.index(token) + 1) + " time(s) for " + self._tag)
+                return 'retry', 0
 
-                # Other unknown error.
-                else:
-                    # Clear cache if not post
-                    self._cache_list = os.urandom(10)
-                    print('\033[31mFATAL ERROR! NOT POSTED BECAUSE OF ' + str(res.status_code))
-                    print(res.text)
-                    print('Telegram API error in ' + self._tag + '!\033[0m')
-        return res
+        # Other unknown error.
+        else:
+            # Clear cache if not post
+            self._invalidate_cache()
+            print('\033[31mFATAL ERROR! NOT POSTED BECAUSE OF ' + str(res.status_code))
+            print(res.text)
+            print('Telegram API error in ' + self._tag + '!\033[0m')
+            return 'retry', 0
 
     def _is_posted(self, news_id):
-        query = "SELECT * FROM {} WHERE news_id = :news_id".format(self._table_name)
-        rows = self._db.execute(query, {"news_id": str(news_id)})
-        if rows.rowcount == 0:
-            return False
-        else:
-            return True
+        return str(news_id) in self._get_posted_ids([news_id])
+
+    def _get_posted_ids(self, news_ids):
+        """
+        Check many news ids by the posted cache, then by storage for unknown ones.
+
+        :param news_ids: news id list.
+        :return: set of posted news ids, as strings.
+        """
+        # Make sure ids posted before are visible to the query
+        self.flush()
+        posted_ids = set()
+        cache = self._get_posted_cache()
+        if cache is not None:
+            posted_ids, news_ids = cache.lookup(news_ids)
+        if news_ids:
+            found_ids = self._storage.get_posted_ids(self._table_name, self._source, news_ids)
+            posted_ids.update(found_ids)
+            if cache is not None:
+                cache.add(found_ids)
+        return posted_ids
 
     def _action(self, no_post=False):  # -> (list, int)
-        duplicate_list = []
+        self._list_modified = False
+        list_results = self._get_lists()
+
+        unique_list, total = self._select_items(list_results)
+        if unique_list is None:
+            return None, total
+
+        # Unchanged items were handled in former cycles
+        posted = total - len(unique_list)
         total = 0
-        for link in self._listURLs:
+        posted_ids = self._get_posted_ids([item['id'] for item in unique_list])
+        new_items = []
+        for item in unique_list:
+            if str(item['id']) not in posted_ids:
+                # The same id may appear again in the list, handle it only once
+                posted_ids.add(str(item['id']))
+                new_items.append(item)
+            else:
+                posted += 1
+                # print(item['id'] + 'Posted!')
+
+        # Fetch full pages in parallel, but post from oldest to newest
+        messages = self._prefetch_full(new_items) if not no_post else []
+        for item, message in zip(new_items, messages):
+            message = message()
+            # print(message)
+
+            # Post the message by api
+            try:
+                res = self._post(message, item['id'])
+            except VideoNotReady as e:
+                self._defer_item(item['id'], e)
+                continue
+            if res is None:
+                print('\033[32m' + str(item['id']) + ' empty message!\033[0m')
+                continue
+            print('\033[32m' + str(item['id']) + ' ' + str(res.status_code) + '\033[0m')
+            total += 1
+        if no_post:
+            for item in new_items:
+                # to set old news item as POSTED
+                self._insert_one_item(item['id'])
+                print('Get ' + item['id'] + ', but no action!')
+                total += 1
+        self.flush()
+        self._commit_validators()
+        return total, posted
+
+    def _defer_item(self, news_id, reason):
+        """Skip an item in this cycle, it is not recorded as posted and handled again in the next cycle."""
+        print('\033[33m' + str(news_id) + ' deferred, ' + str(reason) + '\033[0m')
+        self._deferred_ids.add(str(news_id))
+        # Lists must be downloaded again after restart, until the item is handled
+        self._pending_validators = {}
+
+    def _get_lists(self):
+        """
+        Fetch all list urls, in parallel unless `set_list_workers` is 1.
+
+        A failed url is reported and counted as an empty list, so that it does
+        not drop the items of other urls. Only if all urls fail, the first
+        error is raised.
+
+        :return: (items, number) of each list url, in the order of `_listURLs`.
+        """
+        def get_list(link):
             list_request_url = self._get_request_url(link)
             # print(list_request_url)
-            l, num = self._get_list(list_request_url)
+            return self._get_list(list_request_url, list_url=link)
+
+        if self._list_workers <= 1 or len(self._listURLs) <= 1:
+            results, errors = [], []
+            for link in self._listURLs:
+                try:
+                    results.append(get_list(link))
+                    errors.append(None)
+                except Exception as e:
+                    results.append(None)
+                    errors.append(e)
+        else:
+            with ThreadPoolExecutor(max_workers=min(self._list_workers, len(self._listURLs))) as executor:
+                futures = [executor.submit(get_list, link) for link in self._listURLs]
+            errors = [future.exception() for future in futures]
+            results = [None if error else future.result() for future, error in zip(futures, errors)]
+        if errors and all(errors):
+            raise errors[0]
+
+        list_results = []
+        for link, result, error in zip(self._listURLs, results, errors):
+            if error:
+                print('\033[31mwarning in ' + self._tag + ', skip list ' + link + ' in this cycle')
+                print(error)
+                print('\033[0m')
+                list_results.append(([], 0))
+            else:
+                list_results.append(result)
+        return list_results
+
+    def _select_items(self, list_results):
+        """
+        Merge items of all lists into the items to handle in this cycle.
+
+        :param list_results: (items, number) of each list url.
+        :return: (unique items from oldest to newest, number of items), items is None if
+            nothing need to be handled.
+        """
+        duplicate_list = []
+        total = 0
+        for l, num in list_results:
             total += num
             if l:
                 duplicate_list += l
 
+        # Deferred items are compared as new ones
+        if self._deferred_ids:
+            self._list_diff.discard(self._deferred_ids)
+            self._list_modified = True
+            self._deferred_ids = set()
+
+        # All lists answered 304, nothing to parse or compare
+        if not self._list_modified:
+            return None, total
+
         if not duplicate_list:
+            self._commit_validators()
             return None, total
         # Remain the UNIQUE one from oldest to newest
-        unique_list = []
-        duplicate_list.reverse()
-        for item in duplicate_list:
-            if item not in unique_list:
-                unique_list.append(item)
-        # Hit cache test here
-        list_set = {str(i) for i in unique_list}
-        if list_set != self._cache_list or self._disable_cache:
-            self._cache_list = list_set
-        else:
-            # print('List set is cached!')
-            return None, len(unique_list)
-
-        total = 0
-        posted = 0
+        unique_list = unique_items(duplicate_list)
 
         # Select top item_mun items
         item_mun = min(self._max_list_length, len(unique_list))
+        selected_list = unique_list[-item_mun:]
 
-        unique_list = unique_list[-item_mun:]
-        for item in unique_list:
-            if not self._is_posted(item['id']):
-                if not no_post:
-                    message = self._get_full(item['link'], item=item)
-                    # print(message)
-
-                    # Post the message by api
-                    res = self._post(message, item['id'])
-                    if res is None:
-                        print('\033[32m' + str(item['id']) + ' empty message!\033[0m')
-                        continue
-                    print('\033[32m' + str(item['id']) + ' ' + str(res.status_code) + '\033[0m')
-                else:  # to set old news item as POSTED
-                    self._insert_one_item(item['id'])
-                    print('Get ' + item['id'] + ', but no action!')
-                total += 1
+        # Only new or changed items need to be handled
+        changed_list = self._list_diff.update(selected_list)
+        if self._disable_cache:
+            changed_list = selected_list
+        if not changed_list:
+            # print('List set is cached!')
+            self._commit_validators()
+            return None, len(unique_list)
+        return changed_list, item_mun
+
+    def poll_once(self, sleep_time=30):
+        """
+        Run one cycle, report the result and clean database, errors are reported and not raised.
+
+        :param sleep_time: seconds until the next cycle, only for the report.
+        :return: (total, posted) of `_action`, or None if the cycle failed.
+        """
+        try:
+            total, posted = self._action()
+            if total is None:
+                print(self._tag + ':' + ' ' * (6 - len(self._tag)) + '\tList not modified! ' +
+                      str(min(posted, self._max_list_length)) + ' posted. Wait ' +
+                      str(sleep_time) + 's to restart!')
+                # If the list is not modified, we don't need to clean database
+                # self._clean_database()
             else:
-                posted += 1
-                # print(item['id'] + 'Posted!')
-        return total, posted
+                print(self._tag + ':' + ' ' * (6 - len(self._tag)) + '\t' + str(total) + ' succeeded, '
+                      + str(posted) + ' posted. Wait ' + str(sleep_time) + 's to restart!')
+                self._clean_database()
+            return total, posted
+        except requests.exceptions.ReadTimeout as e:
+            print('\033[31mwarning in', self._tag)
+            print(e)
+            print('\033[0m')
+            self._invalidate_cache()
+            # Clear cache when any error
+            self._extractor._cached_list_items = os.urandom(10)
+        except requests.exceptions.ConnectTimeout as e:
+            print('\033[31mwarning in', self._tag)
+            print(e)
+            print('\033[0m')
+            # Clear cache when any error
+            self._invalidate_cache()
+            self._extractor._cached_list_items = os.urandom(10)
+        except requests.exceptions.ConnectionError as e:
+            print('\033[31mwarning in', self._tag)
+            print(e)
+            print('\033[0m')
+            # Clear cache when any error
+            self._invalidate_cache()
+            self._extractor._cached_list_items = os.urandom(10)
+        except sqlalchemy.exc.InvalidRequestError as e:
+            print('\033[31merror in', self._tag)
+            print('Unknown error!!', e)
+            traceback.print_exc()
+            print('\033[0m')
+            # Clear cache when any error
+            self._invalidate_cache()
+            self._extractor._cached_list_items = os.urandom(10)
+        except FileNotFoundError as e:
+            print('\033[31mfile not found in', self._tag)
+            print(e)
+            print('\033[0m')
+            # Clear cache when any error
+            self._invalidate_cache()
+            self._extractor._cached_list_items = os.urandom(10)
+        except Exception:
+            print('\033[31merror in', self._tag)
+            traceback.print_exc()
+            print('\033[0m')
+            # Clear cache when any error
+            self._invalidate_cache()
+            self._extractor._cached_list_items = os.urandom(10)
+        return None
+
+    def _boot_check(self):
+        if not self._table_name or self._TOKENS.count(None) == len(self._TOKENS) or not self._storage:
+            print('\033[31m' + self._tag + " boot failed! Nothing happened!\033[0m")
+            return False
+        return True
 
-    def poll(self, sleep_time=30):
+    def poll(self, sleep_time=30, adaptive=None):
+        """
+        Poll in a new thread.
+
+        :param sleep_time: seconds to sleep after each cycle.
+        :param adaptive: `telegram_news.scheduler.AdaptiveInterval` to learn the sleep time
+            from the change rate of the list, instead of the fixed `sleep_time`.
+        """
         # Thread work function
         def work():
+            wait = adaptive.interval if adaptive else sleep_time
             while True:
-                try:
-                    total, posted = self._action()
-                    if total is None:
-                        print(self._tag + ':' + ' ' * (6 - len(self._tag)) + '\tList not modified! ' +
-                              str(min(posted, self._max_list_length)) + ' posted. Wait ' +
-                              str(sleep_time) + 's to restart!')
-                        # If the list is not modified, we don't need to clean database
-                        # self._clean_database()
-                    else:
-                        print(self._tag + ':' + ' ' * (6 - len(self._tag)) + '\t' + str(total) + ' succeeded, '
-                              + str(posted) + ' posted. Wait ' + str(sleep_time) + 's to restart!')
-                        self._clean_database()
-                except requests.exceptions.ReadTimeout as e:
-                    print('\033[31mwarning in', self._tag)
-                    print(e)
-                    print('\033[0m')
-                    self._cache_list = os.urandom(10)
-                    # Clear cache when any error
-                    self._extractor._cached_list_items = os.urandom(10)
-                except requests.exceptions.ConnectTimeout as e:
-                    print('\033[31mwarning in', self._tag)
-                    print(e)
-                    print('\033[0m')
-                    # Clear cache when any error
-                    self._cache_list = os.urandom(10)
-                    self._extractor._cached_list_items = os.urandom(10)
-                except requests.exceptions.ConnectionError as e:
-                    print('\033[31mwarning in', self._tag)
-                    print(e)
-                    print('\033[0m')
-                    # Clear cache when any error
-                    self._cache_list = os.urandom(10)
-                    self._extractor._cached_list_items = os.urandom(10)
-                except sqlalchemy.exc.InvalidRequestError as e:
-                    print('\033[31merror in', self._tag)
-                    print('Unknown error!!', e)
-                    traceback.print_exc()
-                    print('\033[0m')
-                    # Clear cache when any error
-                    self._cache_list = os.urandom(10)
-                    self._extractor._cached_list_items = os.urandom(10)
-                except FileNotFoundError as e:
-                    print('\033[31mfile not found in', self._tag)
-                    print(e)
-                    print('\033[0m')
-                    # Clear cache when any error
-                    self._cache_list = os.urandom(10)
-                    self._extractor._cached_list_items = os.urandom(10)
-                except Exception:
-                    print('\033[31merror in', self._tag)
-                    traceback.print_exc()
-                    print('\033[0m')
-                    # Clear cache when any error
-                    self._cache_list = os.urandom(10)
-                    self._extractor._cached_list_items = os.urandom(10)
+                result = self.poll_once(wait)
+                if adaptive and result is not None:
+                    wait = adaptive.update(result[0] or 0)
                 # Sleep when each loop ended
-                sleep(sleep_time)
+                sleep(wait)
 
         # Boot check
-        if not self._table_name or self._TOKENS.count(None) == len(self._TOKENS) or not self._db:
-            print('\033[31m' + self._tag + " boot failed! Nothing happened!\033[0m")
+        if not self._boot_check():
             return
         t = threading.Thread(target=work)
         t.start()
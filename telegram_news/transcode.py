@@ -0,0 +1,294 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Background video transcoding on a process pool.
+
+`save_compressed_video` runs ffmpeg, maybe twice and again when the output
+is still too large, which can take minutes. A `VideoTranscoder` runs these
+jobs in worker processes instead, each with a timeout, so postmen go on
+with other items. An item whose video is not ready raises
+`VideoNotReady` and is tried again in a later cycle.
+
+Outputs are kept in the attachment cache, by the content of the source
+video and the target size, so a video is transcoded once.
+
+    transcoder = VideoTranscoder(max_workers=2, timeout=600)
+    np.enable_download_and_send()
+    np.enable_video_compression()
+    np.set_video_transcoder(transcoder)
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from .utils import save_compressed_video
+
+DEFAULT_MAX_WORKERS = 2
+DEFAULT_TIMEOUT = 600
+
+QUEUED = 'queued'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class VideoNotReady(Exception):
+    """The video of an item is still being transcoded."""
+
+    def __init__(self, job):
+        super(VideoNotReady, self).__init__(job.describe())
+        self.job = job
+
+
+def get_transcode_key(video_full_path, size_upper_bound):
+    """Get the cache key of a transcoded video, the source is named by its content hash in the attachment cache."""
+    return 'compressed:{}:{}'.format(os.path.basename(video_full_path), size_upper_bound)
+
+
+def read_progress(progress_path):
+    """
+    Read the last progress block written by `ffmpeg -progress`.
+
+    :return: dict of progress values, like `out_time_us`, `speed` and `progress`, empty if nothing was written.
+    """
+    progress = {}
+    block = {}
+    try:
+        with open(progress_path, 'r') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return progress
+    for line in lines:
+        key, _, value = line.partition('=')
+        if not key:
+            continue
+        block[key.strip()] = value.strip()
+        # Each block ends with `progress=continue` or `progress=end`
+        if key.strip() == 'progress':
+            progress, block = block, {}
+    return progress or block
+
+
+def _transcode(video_full_path, size_upper_bound, two_pass, timeout, progress_path):
+    """Transcode in a worker process, return (output path or None, error, start time, end time)."""
+    started = time.time()
+    try:
+        output = save_compressed_video(video_full_path, size_upper_bound, two_pass=two_pass, timeout=timeout,
+                                       progress_path=progress_path)
+        error = None if output else 'compression failed'
+    except Exception as e:
+        output, error = None, '{}: {}'.format(type(e).__name__, e)
+    return output or None, error, started, time.time()
+
+
+class TranscodeJob(object):
+    """
+    One video transcoding, with its state and timing metrics.
+
+    Times are by `time.time`, so that they can be compared with the times of worker processes.
+
+    Attributes:
+        key
+        source
+        size_upper_bound
+        state
+        output
+        error
+        queued_at
+        started_at
+        finished_at
+    """
+
+    def __init__(self, key, source, size_upper_bound, state=QUEUED, output=None):
+        self.key = key
+        self.source = source
+        self.size_upper_bound = size_upper_bound
+        self.state = state
+        self.output = output
+        self.error = None
+        self.progress_path = os.path.splitext(source)[0] + '.progress'
+        self.queued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._duration = None
+
+    def done(self):
+        return self.state in (DONE, FAILED)
+
+    @property
+    def wait_time(self):
+        """Seconds in the queue."""
+        if self.started_at is None:
+            return None if self.done() else time.time() - self.queued_at
+        return self.started_at - self.queued_at
+
+    @property
+    def run_time(self):
+        """Seconds of transcoding."""
+        if self.started_at is None:
+            return None
+        return (self.finished_at or time.time()) - self.started_at
+
+    def progress(self):
+        """
+        Get the progress of the running ffmpeg pass.
+
+        :return: float in [0, 1], 1 when done, None if not known.
+        """
+        if self.done():
+            return 1.0
+        values = read_progress(self.progress_path)
+        if not values:
+            return None
+        if values.get('progress') == 'end':
+            return 1.0
+        if values.get('out_time_us', 'N/A') == 'N/A' or not self._get_duration():
+            return None
+        return min(1.0, int(values['out_time_us']) / 1E6 / self._get_duration())
+
+    def _get_duration(self):
+        if self._duration is None:
+            try:
+                import ffmpeg
+                self._duration = float(ffmpeg.probe(self.source)['format']['duration'])
+            except Exception:
+                self._duration = 0
+        return self._duration
+
+    def running(self):
+        """Check if ffmpeg is running the job, it writes progress as soon as it starts."""
+        return not self.done() and bool(read_progress(self.progress_path))
+
+    def describe(self):
+        if not self.done() and not self.running():
+            return 'video queued for {:.0f}s'.format(self.wait_time or 0)
+        progress = self.progress()
+        if progress is None:
+            return 'video transcoding for {:.0f}s'.format(self.run_time or time.time() - self.queued_at)
+        return 'video transcoding {:.0%}'.format(progress)
+
+
+class VideoTranscoder(object):
+    """
+    Queue of video transcoding jobs, run by a process pool and shared by postmen.
+
+    The same source and target size is transcoded once at a time. Outputs
+    are put into the attachment cache given with each job.
+
+    Attributes:
+        max_workers
+        timeout
+        two_pass
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, timeout=DEFAULT_TIMEOUT, two_pass=True, max_failed=1000):
+        """
+        :param int max_workers: max ffmpeg jobs running at the same time.
+        :param timeout: max seconds of one job, not counting the time in the queue.
+        :param two_pass: Set to True to enable two-pass encoding.
+        :param int max_failed: max failed jobs remembered, they are not tried again until they are evicted.
+        """
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.two_pass = two_pass
+        self.max_failed = max_failed
+        self._executor = None
+        self._jobs = {}
+        self._failed = OrderedDict()
+        self._metrics = {'cached': 0, 'submitted': 0, 'done': 0, 'failed': 0, 'wait_time': 0.0, 'run_time': 0.0}
+        self._lock = threading.Lock()
+
+    def submit(self, cache, video_full_path, size_upper_bound):
+        """
+        Get the transcoding job of a video, start it if needed.
+
+        :param cache: AttachmentCache of the video.
+        :param video_full_path: video in `cache`.
+        :param size_upper_bound: Max video size in B.
+        :return: TranscodeJob, done at once if the output is cached or the video is small enough.
+        """
+        key = get_transcode_key(video_full_path, size_upper_bound)
+        with self._lock:
+            if key in self._jobs:
+                return self._jobs[key]
+            if key in self._failed:
+                return self._failed[key]
+
+            output = cache.get(key)
+            if output is None and os.path.getsize(video_full_path) <= size_upper_bound:
+                output = video_full_path
+            if output is not None:
+                self._metrics['cached'] += 1
+                return TranscodeJob(key, video_full_path, size_upper_bound, DONE, output)
+
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            job = TranscodeJob(key, video_full_path, size_upper_bound)
+            self._jobs[key] = job
+            # Keep the source until it is transcoded
+            cache.pin([video_full_path])
+            self._metrics['submitted'] += 1
+            future = self._executor.submit(_transcode, video_full_path, size_upper_bound, self.two_pass,
+                                           self.timeout, job.progress_path)
+        future.add_done_callback(lambda f: self._finish(cache, job, f))
+        return job
+
+    def _finish(self, cache, job, future):
+        try:
+            output, error, job.started_at, job.finished_at = future.result()
+            if output:
+                output = cache.add(job.key, output)
+        except Exception as e:
+            output, error = None, '{}: {}'.format(type(e).__name__, e)
+        cache.unpin([job.source])
+        if job.finished_at is None:
+            job.finished_at = time.time()
+        if os.path.exists(job.progress_path):
+            os.remove(job.progress_path)
+
+        with self._lock:
+            job.output = output
+            job.error = error
+            job.state = DONE if output else FAILED
+            self._metrics['done' if output else 'failed'] += 1
+            if job.started_at is not None:
+                self._metrics['wait_time'] += job.wait_time
+                self._metrics['run_time'] += job.run_time
+            self._jobs.pop(job.key, None)
+            if not output:
+                print('Transcode failed:', job.source, error)
+                self._failed[job.key] = job
+                while len(self._failed) > self.max_failed:
+                    self._failed.popitem(last=False)
+        if output:
+            print('Transcoded {} in {:.1f}s, waited {:.1f}s.'.format(job.source, job.run_time or 0,
+                                                                    job.wait_time or 0))
+
+    def jobs(self):
+        """Get jobs queued or running."""
+        with self._lock:
+            return list(self._jobs.values())
+
+    def stats(self):
+        """
+        Get job counts and times.
+
+        :return: dict with numbers of `cached`, `submitted`, `done`, `failed`, `queued` and `running`
+            jobs, and total seconds of `wait_time` and `run_time` of finished jobs.
+        """
+        with self._lock:
+            jobs = list(self._jobs.values())
+            stats = dict(self._metrics)
+        # A job is running as soon as ffmpeg writes its progress
+        stats['running'] = len([job for job in jobs if job.running()])
+        stats['queued'] = len(jobs) - stats['running']
+        return stats
+
+    def shutdown(self, wait=True):
+        """Stop the worker processes, queued jobs are cancelled if `wait` is False."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
@@ -12,9 +12,17 @@ import os
 import requests
 import math
 import hashlib
+import subprocess
+import threading
+import time
 
 import xmltodict
 from bs4 import BeautifulSoup
+from bs4.element import (
+    CData,
+    NavigableString,
+    Tag,
+)
 
 try:
     import urlparse
@@ -54,67 +62,152 @@ from .constant import (
     MAX_THUMB_SIZE
 )
 
-def keep_media(text, url, with_link=True):
+_TEXT_TYPES = (NavigableString, CData)
+_ASCII_WHITESPACE = ' \t\n\r\f'
+
+
+def _escape(text):
+    return text.replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _walk(soup, with_links, wrapper=None):
     """
-    Remove tags except media tags.
+    Walk the tree once and yield text, media and link nodes in document order.
+
+    Media tags (and link tags, if `with_links`) are yielded as a whole, their
+    children are not visited. Text is yielded as the same strings `getText` uses,
+    and 'start' and 'end' mark where other tags begin and end.
+    """
+    stack = [(iter(soup.contents), False)]
+    while stack:
+        children, in_tag = stack[-1]
+        node = next(children, None)
+        if node is None:
+            stack.pop()
+            if in_tag:
+                yield 'end', None
+            continue
+        if isinstance(node, Tag):
+            if node.name in ('img', 'video'):
+                yield 'media', node
+            elif with_links and node.name == 'a':
+                yield 'link', node
+            else:
+                # Tags added by the parser or by ourselves are not in the original text
+                in_tag = node.name not in ('html', 'body') and node is not wrapper
+                if in_tag:
+                    yield 'start', node
+                stack.append((iter(node.contents), in_tag))
+        elif type(node) in _TEXT_TYPES:
+            yield 'text', node
+
+
+def _drop_leading_blanks(events):
+    """Drop blanks before the first tag, as the parser does at the beginning of a document."""
+    for index, (kind, node) in enumerate(events):
+        if kind != 'text':
+            return
+        text = node.lstrip(_ASCII_WHITESPACE)
+        events[index] = (kind, text)
+        if text:
+            return
+
+
+def _render_media_segment(events, url, with_link):
+    """Render text and media events between two links, as same as `keep_media` does."""
+    result = ''
+    texts = []
+    last_media = None
+    for index, (kind, node) in enumerate(events):
+        if kind == 'media':
+            last_media = index
+
+    # The plain text behind the last media used to be parsed as a new document
+    if last_media is not None:
+        tail = events[last_media + 1:]
+        _drop_leading_blanks(tail)
+        events = events[:last_media + 1] + tail
+
+    for kind, node in events:
+        if kind == 'text':
+            texts.append(node)
+            continue
+        if kind in ('start', 'end'):
+            continue
+
+        # Plain text before each media is stripped
+        result += _escape(''.join(texts).strip())
+        texts = []
+        media_link = node.get('src')
+        if media_link:
+            # If the media link is a relative path
+            media_link = get_full_link(media_link, url)
+            if with_link:
+                # Embed the media as a link
+                result += '<a href=\"' + media_link + '\">' + '[Media]' + '</a>'
+            else:
+                result += '[Media]'
+
+    # The plain text behind keeps its blanks
+    return result + _escape(''.join(texts))
+
+
+def sanitize_html(text, url, with_media_link=True, with_links=True):
+    """
+    Convert HTML to the subset Telegram API parses, by walking the tree once.
+
+    Text is escaped, media become `[Media]` (links) and, if `with_links`,
+    <a></a> is kept with an absolute url. The output is as same as the
+    former split-and-reparse implementation of `keep_link` and `keep_media`.
 
     :param text: raw text string.
     :param url: base url of the website.
+    :param with_media_link: boolean, whether keep media symbol link.
+    :param with_links: boolean, whether keep <a></a>.
     :return: processed string.
     """
     if not text:
         return ''
 
-    text = '<div>' + text + '</div>'  # text = '</div>blabla<div>'
-
-    soup = BeautifulSoup(text, 'lxml')
-    # print(text)
+    soup = BeautifulSoup('<div>' + text + '</div>', 'lxml')
+    events = list(_walk(soup, with_links, wrapper=soup.find('div')))
 
-    # Keep the first blank if have
-    blank_num = 0
-    if text[0] == ' ':
-        blank_num = 1
+    if not any(kind == 'link' for kind, _ in events):
+        return _render_media_segment(events, url, with_media_link)
 
-    # No media here, return directly
-    if not soup.select('img, video'):
-        return ' ' * blank_num + soup.getText().replace('<', '&lt;').replace('>', '&gt;')
-
-    # Find media
-    else:
-        # Copy from original text
-        cp = str(soup)
+    # Text with links used to be parsed without the <div> wrapper, where the
+    # parser drops blanks at the beginning of the document.
+    _drop_leading_blanks(events)
 
-        # The target string
-        result = ""
-
-        media_list = soup.select('img, video')
-
-        # Remove other tags, except <a>
-        for media in media_list:
+    result = ''
+    segment = []
+    for kind, node in events:
+        if kind != 'link':
+            segment.append((kind, node))
+            continue
 
-            # Split the text by <img> tag and <video> tag
-            other = str(cp).split(str(media))
+        result += _render_media_segment(segment, url, with_media_link)
+        segment = []
 
-            # Get the media url
-            media_link = media.get('src')
+        # Not keep <a> without any text or link
+        content = _escape(node.get_text())
+        link_url = node.get('href')
+        if content and link_url:
+            link_url = get_full_link(link_url, url)
+            result += '<a href=\"' + link_url + '\">' + content.strip() + '</a>'
 
-            # Get plain text and concatenate with link
-            result += BeautifulSoup(other[0], 'lxml').getText().strip().replace('<', '&lt;').replace('>', '&gt;')
-            if media_link:
-                # If the media link is a relative path
-                media_link = get_full_link(media_link, url)
+    return result + _render_media_segment(segment, url, with_media_link)
 
-                if with_link:
-                    # Embed the media as a link
-                    result += '<a href=\"' + media_link + '\">' + '[Media]' + '</a>'
-                else:
-                    result += '[Media]'
 
-            # Remove the processed text from processing string
-            cp = str(cp).replace(str(other[0]) + str(media), "")
+def keep_media(text, url, with_link=True):
+    """
+    Remove tags except media tags.
 
-        # Return processed text and the plain text behind
-        return ' ' * blank_num + result + BeautifulSoup(cp, 'lxml').getText().replace('<', '&lt;').replace('>', '&gt;')
+    :param text: raw text string.
+    :param url: base url of the website.
+    :return: processed string.
+    """
+    return sanitize_html(text, url, with_media_link=with_link, with_links=False)
 
 
 def keep_img(text, url, with_link=True):
@@ -139,47 +232,7 @@ def keep_link(text, url, with_media_link=True):
     # Ignore HTML comment
     text = re.sub(r'<!--[\s\S]*?-->', '', text)
 
-    soup = BeautifulSoup(text, 'lxml')
-
-    # No link here, return directly
-    if not soup.select('a'):
-        return keep_media(text, url, with_media_link)
-
-    # Find link(s)
-    else:
-
-        # Copy from original text
-        cp = str(soup)
-
-        # The target string
-        result = ""
-
-        # Remove other tags, except <a>
-        for link in soup.select('a'):
-
-            # Split the text by <a> tag
-            other = str(cp).split(str(link))
-
-            # Get the link url
-            content = link.get_text().replace('<', '&lt;').replace('>', '&gt;')
-            link_url = link.get('href')
-
-            # Get plain text and concatenate with link
-            result += keep_media(other[0], url, with_media_link)
-
-            # Not keep <a> without any text or link
-            if content:
-                if link_url:
-                    link_url = get_full_link(link_url, url)
-                    result += '<a href=\"' + link_url + '\">' + str(content).strip() + '</a>'
-                else:
-                    str(content)
-
-            # Remove the processed text from processing string
-            cp = str(cp).replace(str(other[0]) + str(link), "")
-
-        # Return processed text and the plain text behind
-        return result + keep_media(cp, url, with_media_link)
+    return sanitize_html(text, url, with_media_link=with_media_link, with_links=True)
 
 
 def is_single_media(text):
@@ -315,28 +368,139 @@ def get_video_from_select(tags_select, link):
     return videos
 
 
-def download_file_by_url(url, filename, header=None, max_retry=10):
+def _get_total_length(res, offset):
+    """Get the full length of a file from a 200 or 206 response, None if unknown."""
+    content_range = res.headers.get('Content-Range', '')
+    if res.status_code == 206 and '/' in content_range and not content_range.endswith('*'):
+        return int(content_range.rsplit('/', 1)[1])
+    if 'Content-Length' in res.headers:
+        return offset + int(res.headers['Content-Length'])
+    return None
+
+
+_download_locks = {}
+_download_locks_lock = threading.Lock()
+
+
+def _acquire_download_lock(filename):
+    """Get the lock of a download target, counted so that unused locks are dropped."""
+    with _download_locks_lock:
+        entry = _download_locks.setdefault(filename, [threading.Lock(), 0])
+        entry[1] += 1
+    entry[0].acquire()
+    return entry
+
+
+def _release_download_lock(filename, entry):
+    entry[0].release()
+    with _download_locks_lock:
+        entry[1] -= 1
+        if not entry[1]:
+            del _download_locks[filename]
+
+
+def download_file_by_url(url, filename, header=None, max_retry=10, session=None, max_size=None,
+                         chunk_size=64 * 1024, timeout=30):
+    """
+    Download a file by streaming it to `filename`.
+
+    Data is written to `filename` + '.part' chunk by chunk and renamed to
+    `filename` only when complete, so an existing `filename` is always a
+    whole file. After a network error, the download is resumed from the
+    size of the part file by a HTTP Range request.
+
+    Downloads to the same `filename` in this process run one at a time, so
+    that they never write the same part file together.
+
+    :param url: file url.
+    :param filename: path to save, default is the base name of the url.
+    :param header: request headers.
+    :param max_retry: max retries after network errors.
+    :param session: `requests` or a session to send requests.
+    :param max_size: max bytes of the file, larger files are not downloaded.
+    :param chunk_size: bytes read and written at a time.
+    :param timeout: seconds to wait for the server.
+    :return: True if `filename` is complete, otherwise False.
+    """
     if not filename:
         filename = os.path.basename(urlparse(url).path)
+    key = os.path.abspath(filename)
+    lock = _acquire_download_lock(key)
+    try:
+        return _download_file(url, filename, header, max_retry, session, max_size, chunk_size, timeout)
+    finally:
+        _release_download_lock(key, lock)
+
+
+def _download_file(url, filename, header, max_retry, session, max_size, chunk_size, timeout):
+    if session is None:
+        session = requests
     if os.path.exists(filename):
-        return
+        return True
+    part_filename = filename + '.part'
 
     # Retry only when there is no network error
     max_retry = max_retry
     while max_retry:
+        offset = os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
+        headers = dict(header or {})
+        # Byte ranges are only meaningful without content encoding
+        headers['Accept-Encoding'] = 'identity'
+        if offset:
+            headers['Range'] = 'bytes=' + str(offset) + '-'
         try:
-            # Use requests.get to download target file, and write to a new file.
-            r = requests.get(url, headers=header)
-            if r.status_code != 200:
-                print('File not found! Code:', r.status_code, 'URL:', url)
-                return
-            with open(filename, 'wb') as f:
-                f.write(r.content)
+            # Use requests.get to stream target file, and write to the part file.
+            with session.get(url, headers=headers, stream=True, timeout=timeout) as r:
+                if r.status_code == 416 and offset:
+                    # The part file is not a prefix of the file any more, download again
+                    os.remove(part_filename)
+                    continue
+                if r.status_code not in (200, 206):
+                    print('File not found! Code:', r.status_code, 'URL:', url)
+                    return False
+                if r.status_code == 200:
+                    # The server ignored the range, download from the beginning
+                    offset = 0
+
+                length = _get_total_length(r, offset)
+                if max_size and length is not None and length > max_size:
+                    print('File too large (' + str(length) + ' bytes)! URL:', url)
+                    if os.path.exists(part_filename):
+                        os.remove(part_filename)
+                    return False
+
+                size = offset
+                with open(part_filename, 'ab' if offset else 'wb') as f:
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        size += len(chunk)
+                        if max_size and size > max_size:
+                            break
+                        f.write(chunk)
+                if max_size and size > max_size:
+                    print('File too large (over ' + str(max_size) + ' bytes)! URL:', url)
+                    os.remove(part_filename)
+                    return False
+                if length is not None and size < length:
+                    raise IOError('connection closed at ' + str(size) + ' of ' + str(length) + ' bytes')
         except Exception as e:
             print('Download file ' + url + ' failed (' + str(e) + ')! Retry ' + str(max_retry) + ' time(s).')
             max_retry -= 1
             continue
-        break
+        os.replace(part_filename, filename)
+        return True
+    return False
+
+
+def check_file(path):
+    """
+    Make sure a file exists.
+
+    :return: `path`.
+    :raises FileNotFoundError: if the file does not exist.
+    """
+    if not os.path.isfile(path):
+        raise FileNotFoundError('No such file: ' + str(path))
+    return path
 
 
 def get_network_file(url):
@@ -374,15 +538,31 @@ def save_compressed_image(image, image_full_path, size_upper_bound):
             cv2.imwrite(image_full_path, decimg)
 
 
-def save_compressed_video(video_full_path, size_upper_bound, two_pass=True, filename_suffix='1'):
+def _run_ffmpeg(stream, deadline=None, progress_path=None):
+    """Run an ffmpeg-python stream, killed at `deadline` (by `time.monotonic`)."""
+    if progress_path:
+        stream = stream.global_args('-progress', progress_path)
+    timeout = None
+    if deadline is not None:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            raise subprocess.TimeoutExpired(stream.compile(), 0)
+    subprocess.run(stream.overwrite_output().compile(), timeout=timeout, check=True)
+
+
+def save_compressed_video(video_full_path, size_upper_bound, two_pass=True, filename_suffix='1', timeout=None,
+                          progress_path=None):
     """
     Compress video file to max-supported size.
     :param video_full_path: the video you want to compress.
     :param size_upper_bound: Max video size in B.
     :param two_pass: Set to True to enable two-pass calculation.
     :param filename_suffix: Add a suffix for new video.
+    :param timeout: Max seconds for all ffmpeg runs, the compression fails after it.
+    :param progress_path: File for ffmpeg to write progress of the running pass.
     :return: out_put_name or error
     """
+    deadline = None if timeout is None else time.monotonic() + timeout
     if not os.path.exists(video_full_path):
         return False
     if os.path.getsize(video_full_path) <= size_upper_bound:
@@ -442,21 +622,35 @@ def save_compressed_video(video_full_path, size_upper_bound, two_pass=True, file
 
         i = ffmpeg.input(video_full_path)
         if two_pass:
-            ffmpeg.output(i, '/dev/null' if os.path.exists('/dev/null') else 'NUL',
-                          **{'c:v': 'libx264', 'b:v': video_bitrate, 'pass': 1, 'f': 'mp4'}
-                          ).overwrite_output().run()
-            ffmpeg.output(i, output_file_name,
-                          **{'c:v': 'libx264', 'b:v': video_bitrate, 'pass': 2, 'c:a': 'aac', 'b:a': audio_bitrate}
-                          ).overwrite_output().run()
+            # Logs of the first pass next to the output, so that jobs in parallel do not share them
+            pass_log_file = filename + filename_suffix + '-pass'
+            try:
+                _run_ffmpeg(ffmpeg.output(i, '/dev/null' if os.path.exists('/dev/null') else 'NUL',
+                                          **{'c:v': 'libx264', 'b:v': video_bitrate, 'pass': 1, 'f': 'mp4',
+                                             'passlogfile': pass_log_file}),
+                            deadline, progress_path)
+                _run_ffmpeg(ffmpeg.output(i, output_file_name,
+                                          **{'c:v': 'libx264', 'b:v': video_bitrate, 'pass': 2, 'c:a': 'aac',
+                                             'b:a': audio_bitrate, 'passlogfile': pass_log_file}),
+                            deadline, progress_path)
+            finally:
+                for log_file in (pass_log_file + '-0.log', pass_log_file + '-0.log.mbtree'):
+                    if os.path.exists(log_file):
+                        os.remove(log_file)
         else:
-            ffmpeg.output(i, output_file_name,
-                          **{'c:v': 'libx264', 'b:v': video_bitrate, 'c:a': 'aac', 'b:a': audio_bitrate}
-                          ).overwrite_output().run()
+            _run_ffmpeg(ffmpeg.output(i, output_file_name,
+                                      **{'c:v': 'libx264', 'b:v': video_bitrate, 'c:a': 'aac', 'b:a': audio_bitrate}),
+                        deadline, progress_path)
 
         if os.path.getsize(output_file_name) <= size_upper_bound:
             return output_file_name
         elif os.path.getsize(output_file_name) < os.path.getsize(video_full_path):  # Do it again
-            return save_compressed_video(output_file_name, size_upper_bound)
+            timeout = None if deadline is None else deadline - time.monotonic()
+            result = save_compressed_video(output_file_name, size_upper_bound, timeout=timeout,
+                                           progress_path=progress_path)
+            if result != output_file_name:
+                os.remove(output_file_name)
+            return result
         else:
             return False
     except FileNotFoundError as e:
@@ -464,6 +658,11 @@ def save_compressed_video(video_full_path, size_upper_bound, two_pass=True, file
         print('You do not have ffmpeg installed!', e)
         print('You can install ffmpeg by reading https://github.com/kkroening/ffmpeg-python/issues/251')
         return False
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, ffmpeg.Error) as e:
+        print('Compress video failed:', video_full_path, e)
+        if os.path.exists(output_file_name):
+            os.remove(output_file_name)
+        return False
 
 
 def extract_video_config(video_full_path, thumb_full_path, thumb_name):
@@ -525,8 +724,10 @@ def detect_and_download_video(url, path, name, verbose):
         return None
 
 
-def get_file_length(url):
-    res = requests.get(url, stream=True)
+def get_file_length(url, session=None):
+    if session is None:
+        session = requests
+    res = session.get(url, stream=True)
     if res.status_code == 200:
         if 'Content-Length' in res.headers:
             return res.headers['Content-Length']